@@ -1,5 +1,13 @@
-from canvassyncer.__main__ import run
-
-
 def main():
+    from canvassyncer.__main__ import run
+
     run()
+
+
+def __getattr__(name):
+    # importing the CLI here would run it twice under python -m canvassyncer
+    if name == "run":
+        from canvassyncer.__main__ import run
+
+        return run
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
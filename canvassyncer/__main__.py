@@ -1,138 +1,1840 @@
 import argparse
 import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import importlib.util
+import itertools
 import json
-import mimetypes
+import multiprocessing
 import ntpath
 import os
 import platform
+import random
 import re
+import shutil
+import sys
+import threading
 import time
 import traceback
 from datetime import datetime, timezone
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
-import aiofiles
-import httpx
-from tqdm import tqdm
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+class LazyModule:
+    """Imports a module on its first use, so that -V and -h do not wait for
+    the import of httpx and tqdm, nor runs without downloads for tqdm.
+
+    PyInstaller cannot see these imports, build.spec lists them as hidden
+    imports.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+httpx = LazyModule("httpx")
+tqdm = LazyModule("tqdm")
 
 __version__ = "2.0.12"
 CONFIG_PATH = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), ".canvassyncer.json"
 )
-PAGES_PER_TIME = 8
+PER_PAGE = 100
+INDEX_FILENAME = ".canvassyncer_index.jsonl"
+COURSES_FILENAME = ".canvassyncer_courses.json"
+DOWNLOAD_RETRIES = 3
+THROTTLED_RETRIES = 10
+LOW_RATE_LIMIT_QUOTA = 50
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ENDPOINT_KINDS = (
+    "courses",
+    "folders",
+    "files",
+    "modules",
+    "items",
+    "assignments",
+    "pages",
+    "discussion_topics",
+)
+FS_WORKERS = 4
+FILE_CATEGORIES = ("audio", "video", "image", "other")
+DOWNLOAD_ORDERS = ("listing", "smallest", "newest", "course")
+PROGRESS_INTERVAL = 0.1
+JSON_PROGRESS_INTERVAL = 5
+PROGRESS_MODES = ("auto", "bar", "course", "file", "json", "quiet")
+CHUNK_SIZE = 256
+TEMP_MAX_AGE = 7 * 24 * 3600
+VERIFY_CHUNKSIZE = 16
+# the categories of mimetypes for the common extensions, without loading its
+# database on the first lookup
+FILE_EXTENSIONS = {
+    extension: category
+    for category, extensions in (
+        (
+            "audio",
+            ".3g2 .3gp .3gpp .3gpp2 .aac .adts .aif .aifc .aiff .au .flac .loas .m4a "
+            ".mid .midi .mp2 .mp3 .oga .ogg .opus .ra .snd .wav .weba .wma",
+        ),
+        (
+            "video",
+            ".avi .flv .m1v .m4v .mkv .mov .movie .mp4 .mpa .mpe .mpeg .mpg .ogv "
+            ".qt .webm .wmv",
+        ),
+        (
+            "image",
+            ".avif .bmp .gif .heic .heif .ico .ief .jpe .jpeg .jpg .jxl .pbm .pct "
+            ".pgm .pic .pict .png .pnm .ppm .psd .ras .rgb .svg .tif .tiff .webp "
+            ".xbm .xpm .xwd",
+        ),
+    )
+    for extension in extensions.split()
+}
+DISCOVERY_SOURCES = ("modules", "assignments", "pages", "announcements")
+FILE_LINK = re.compile(r"/files/(\d+)")
+PLAN_FIELDS = ("id", "size", "modified_at", "updated_at", "md5", "course")
+WRITE_BUFFER_SIZE = 1 << 20
+SPLIT_CHECKPOINT_SIZE = 16 << 20
 
 
-class AsyncSemClient:
-    def __init__(self, connectionCount, token, proxy):
-        self.sem = asyncio.Semaphore(connectionCount)
-        self.client = httpx.AsyncClient(
-            timeout=5,
-            headers={"Authorization": f"Bearer {token}"},
+def withQuery(url, **params):
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    query = dict(parse_qsl(query, keep_blank_values=True))
+    query.update({key: str(val) for key, val in params.items()})
+    return urlunsplit((scheme, netloc, path, urlencode(query), fragment))
+
+
+def pageNumber(url):
+    page = dict(parse_qsl(urlsplit(url).query)).get("page", "")
+    return int(page) if page.isdigit() else None
+
+
+class Record:
+    """A JSON object projected onto the fields listed in __slots__.
+
+    It is read like the dict it replaces, but keeps no per-object dict.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def fromJson(cls, obj):
+        record = cls()
+        for key in cls.__slots__:
+            if key in obj:
+                setattr(record, key, obj[key])
+        return record
+
+    def toJson(self):
+        return {key: getattr(self, key) for key in self.__slots__ if key in self}
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, val):
+        setattr(self, key, val)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+class FolderRecord(Record):
+    __slots__ = ("id", "full_name")
+
+
+class FileRecord(Record):
+    __slots__ = (
+        "id",
+        "folder_id",
+        "display_name",
+        "url",
+        "size",
+        "modified_at",
+        "updated_at",
+        "md5",
+    )
+
+
+async def readJsonRecords(resp, recordType):
+    # decode a JSON array element by element as it arrives, so only the
+    # projected records of a listing page are kept in memory
+    decoder = json.JSONDecoder()
+    records = []
+    buffer = ""
+    isArray = None
+    async for text in resp.aiter_text():
+        buffer += text
+        if isArray is None:
+            buffer = buffer.lstrip()
+            if not buffer:
+                continue
+            isArray = buffer[0] == "["
+            if isArray:
+                buffer = buffer[1:]
+        if not isArray:
+            continue
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break
+            # a value running up to the end of the buffer may be cut short
+            if end == len(buffer):
+                break
+            records.append(recordType.fromJson(obj) if isinstance(obj, dict) else obj)
+            pos = end
+        buffer = buffer[pos:]
+    if not isArray:
+        # errors come as an object, which is small enough to decode at once
+        return json.loads(buffer)
+    if buffer.strip() != "]":
+        raise ValueError("Truncated JSON array")
+    return records
+
+
+class SyncIndex:
+    """Append-only JSON-lines log of the files synced into downloadDir.
+
+    Each line records one file, keyed by its path relative to downloadDir, or
+    the listing watermark of one course, keyed by its course ID. The last line
+    for a key wins, a deleted path is marked by a line with "deleted", and the
+    log is compacted when it grows too long.
+    """
+
+    def __init__(self, downloadDir, compactable=True):
+        self.path = os.path.join(downloadDir, INDEX_FILENAME)
+        self.compactable = compactable
+        self.records = {}
+        self.courses = {}
+        self.digests = {}
+        self.ids = {}
+        self.lineCount = 0
+        # the log is appended from the filesystem threads
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, mode="r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn line left by an interrupted run
+                    continue
+                self.lineCount += 1
+                if "course_id" in record:
+                    self.courses[record["course_id"]] = record
+                else:
+                    self.remember(record)
+        self.compactIfNeeded()
+
+    def remember(self, record):
+        if record.get("deleted"):
+            self.records.pop(record["path"], None)
+            return
+        self.records[record["path"]] = record
+        if record.get("md5"):
+            self.digests[(record["md5"], record["size"])] = record["path"]
+        if record.get("id") is not None:
+            self.ids[record["id"]] = record["path"]
+
+    def compactIfNeeded(self):
+        # processes appending to the same index leave compaction to the parent
+        if (
+            self.compactable
+            and self.lineCount > 2 * (len(self.records) + len(self.courses)) + 100
+        ):
+            self.compact()
+
+    def compact(self):
+        records = [*self.records.values(), *self.courses.values()]
+        tempPath = self.path + ".temp"
+        with open(tempPath, mode="w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tempPath, self.path)
+        self.lineCount = len(records)
+
+    def get(self, path):
+        return self.records.get(path)
+
+    def getCourse(self, courseID):
+        return self.courses.get(str(courseID))
+
+    def findDigest(self, digest, size):
+        path = self.digests.get((digest, size))
+        record = self.records.get(path)
+        if record is None or record.get("md5") != digest or record.get("corrupt"):
+            return None
+        return record
+
+    def findID(self, fileID):
+        record = self.records.get(self.ids.get(fileID))
+        if record is None or record.get("id") != fileID:
+            return None
+        return record
+
+    def append(self, record):
+        with self.lock:
+            with open(self.path, mode="a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.lineCount += 1
+            self.compactIfNeeded()
+
+    def updateCourse(self, record):
+        self.courses[record["course_id"]] = record
+        self.append(record)
+
+
+class CourseDirectory:
+    """Courses of one account seen on canvas, cached in downloadDir.
+
+    Each course is kept for ttl seconds after it was fetched, so unchanged
+    course codes and IDs resolve without any request.
+    """
+
+    def __init__(self, downloadDir, baseUrl, token, ttl):
+        self.path = os.path.join(downloadDir, COURSES_FILENAME)
+        self.account = hashlib.sha256(f"{baseUrl}\n{token}".encode()).hexdigest()
+        self.ttl = ttl
+        self.courses = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, mode="r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("account") == self.account:
+            self.courses = data.get("courses", {})
+
+    def save(self):
+        if not self.changed or self.ttl <= 0:
+            return
+        tempPath = self.path + ".temp"
+        with open(tempPath, mode="w", encoding="utf-8") as f:
+            json.dump({"account": self.account, "courses": self.courses}, f)
+        os.replace(tempPath, self.path)
+        self.changed = False
+
+    def add(self, course):
+        if not isinstance(course, dict) or "id" not in course:
+            return
+        self.courses[str(course["id"])] = {
+            "id": course["id"],
+            "course_code": course.get("course_code"),
+            "name": course.get("name"),
+            "term": (course.get("term") or {}).get("name"),
+            "workflow_state": course.get("workflow_state"),
+            "updated_at": course.get("updated_at"),
+            "fetched_at": time.time(),
+        }
+        self.changed = True
+
+    def isFresh(self, record):
+        return time.time() - record["fetched_at"] < self.ttl
+
+    def byID(self, courseID):
+        record = self.courses.get(str(courseID))
+        return record if record and self.isFresh(record) else None
+
+    def byCode(self, lowerCourseCode):
+        for record in self.courses.values():
+            if (record["course_code"] or "").lower() == lowerCourseCode:
+                return record if self.isFresh(record) else None
+        return None
+
+
+def fileMd5(path, length=None):
+    md5 = hashlib.md5()
+    remaining = os.path.getsize(path) if length is None else length
+    with open(path, mode="rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            md5.update(chunk)
+            remaining -= len(chunk)
+    return md5
+
+
+def linkFile(src, dst):
+    dst_temp = dst + ".temp"
+    if os.path.exists(dst_temp):
+        os.remove(dst_temp)
+    try:
+        os.link(src, dst_temp)
+    except OSError:
+        # hardlinks are not supported across devices or on some filesystems
+        shutil.copyfile(src, dst_temp)
+    os.replace(dst_temp, dst)
+
+
+def responseValidator(resp):
+    etag = resp.headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return resp.headers.get("last-modified")
+
+
+def readValidator(tempPath):
+    try:
+        with open(tempPath + ".etag", mode="r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def writeValidator(tempPath, validator):
+    with open(tempPath + ".etag", mode="w", encoding="utf-8") as f:
+        f.write(validator)
+
+
+def removeValidator(tempPath):
+    if os.path.exists(tempPath + ".etag"):
+        os.remove(tempPath + ".etag")
+
+
+def readSplitState(tempPath, size):
+    try:
+        with open(tempPath + ".parts", mode="r", encoding="utf-8") as f:
+            state = json.load(f)
+        if state["size"] != size or os.path.getsize(tempPath) != size:
+            return None
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return state
+
+
+def writeSplitState(tempPath, state):
+    statePath = tempPath + ".parts"
+    with open(statePath + ".temp", mode="w", encoding="utf-8") as f:
+        json.dump({key: state[key] for key in ("size", "validator", "parts")}, f)
+    os.replace(statePath + ".temp", statePath)
+
+
+def removeSplitState(tempPath):
+    if os.path.exists(tempPath + ".parts"):
+        os.remove(tempPath + ".parts")
+
+
+def canSplit(tempPath):
+    # a download begun in one stream is resumed in one stream
+    return os.path.exists(tempPath + ".parts") or not os.path.exists(tempPath)
+
+
+def resumeState(tempPath):
+    offset = os.path.getsize(tempPath) if os.path.exists(tempPath) else 0
+    return offset, readValidator(tempPath) if offset else None
+
+
+def commitDownload(tempPath, dst):
+    os.replace(tempPath, dst)
+    removeValidator(tempPath)
+    removeSplitState(tempPath)
+
+
+def moveFile(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.replace(src, dst)
+
+
+def discardDownload(tempPath):
+    if os.path.exists(tempPath):
+        os.remove(tempPath)
+    removeValidator(tempPath)
+    removeSplitState(tempPath)
+
+
+def fileDigest(path):
+    return fileMd5(path).hexdigest()
+
+
+def verifyFile(path):
+    try:
+        return os.path.getsize(path), fileDigest(path)
+    except FileNotFoundError:
+        return None
+
+
+class IntegrityError(Exception):
+    pass
+
+
+def isMd5(value):
+    # canvas may store other checksums in the md5 field
+    return bool(value) and re.fullmatch(r"[0-9a-f]{32}", value) is not None
+
+
+def checkIntegrity(dst, size, digest, expectedSize=None, expectedMd5=None):
+    if expectedSize is not None and size != expectedSize:
+        raise IntegrityError(f"Got {size} of {expectedSize} bytes: {dst}")
+    if isMd5(expectedMd5):
+        if digest != expectedMd5:
+            raise IntegrityError(f"Checksum mismatch: {dst}")
+
+
+def preallocate(f, size):
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        # not available on this platform or filesystem
+        f.truncate(size)
+
+
+class FileSystem:
+    """Runs blocking filesystem calls in a small dedicated thread pool.
+
+    Slow disks and network filesystems then hold up these threads instead of
+    the event loop and every download in flight.
+    """
+
+    def __init__(self, workers=FS_WORKERS):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix="canvassyncer-fs"
+        )
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def open(self, path, mode, offset=0, size=None, md5=None):
+        return FileWriter(self, path, mode, offset, size, md5)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class FileWriter:
+    """Coalesces the small chunks of a response into large writes, which run
+    in the filesystem executor along with the md5 update of the data.
+
+    The file is fsynced before it is closed after a successful write.
+    """
+
+    def __init__(self, fs, path, mode, offset=0, size=None, md5=None):
+        self.fs = fs
+        self.path = path
+        self.mode = mode
+        self.offset = offset
+        self.size = size
+        self.md5 = md5
+        self.file = None
+        self.buffer = []
+        self.buffered = 0
+        # the end of the data handed to the file
+        self.flushed = offset
+
+    async def __aenter__(self):
+        self.file = await self.fs.run(self.openFile)
+        return self
+
+    async def __aexit__(self, excType, exc, tb):
+        try:
+            # keep what was received, a partial download may be resumed
+            await self.flush()
+        finally:
+            await self.fs.run(self.closeFile, excType is None)
+
+    def openFile(self):
+        f = open(self.path, self.mode)
+        if self.size:
+            preallocate(f, self.size)
+        if self.offset:
+            f.seek(self.offset)
+        return f
+
+    def closeFile(self, sync):
+        try:
+            if sync:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+        finally:
+            self.file.close()
+
+    def writeData(self, data):
+        self.file.write(data)
+        self.flushed += len(data)
+        if self.md5 is not None:
+            self.md5.update(data)
+
+    async def write(self, chunk):
+        self.buffer.append(chunk)
+        self.buffered += len(chunk)
+        if self.buffered >= WRITE_BUFFER_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        data = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        await self.fs.run(self.writeData, data)
+
+    async def checkpoint(self):
+        # hand everything written so far to the OS, so that it survives the
+        # process being killed
+        await self.flush()
+        await self.fs.run(self.file.flush)
+
+
+def endpointKind(url):
+    path = re.sub(r"/\d+", "", urlsplit(url).path.rstrip("/"))
+    kind = path.rsplit("/", 1)[-1]
+    return kind if kind in ENDPOINT_KINDS else "other"
+
+
+def peakRss():
+    # ru_maxrss is kept across exec, so a process started by a larger one
+    # would report the peak of its parent, linux also tracks its own peak
+    try:
+        with open("/proc/self/status", mode="r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    return maxRss if platform.system() == "Darwin" else maxRss * 1024
+
+
+def linkedFileIDs(html):
+    # links and api endpoints of files embedded in canvas html
+    return {int(fileID) for fileID in FILE_LINK.findall(html or "")}
+
+
+def fileCategory(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return FILE_EXTENSIONS.get(extension, "other")
+
+
+def scheduleDownloads(infos, order="listing", typePriority=None):
+    """Order download infos by file type priority (lower first), then by the
+    given policy: listing order, smallest or newest first, or round-robin
+    across courses."""
+    typePriority = typePriority or {}
+    groups = {}
+    for info in infos:
+        priority = typePriority.get(fileCategory(info[1]), 0)
+        groups.setdefault(priority, []).append(info)
+    res = []
+    for priority in sorted(groups):
+        group = groups[priority]
+        if order == "smallest":
+            group.sort(key=lambda info: info[2])
+        elif order == "newest":
+            group.sort(key=lambda info: info[4]["modified_at"], reverse=True)
+        elif order == "course":
+            courses = {}
+            for info in group:
+                courses.setdefault(info[4]["course"], []).append(info)
+            group = [
+                info
+                for infos in itertools.zip_longest(*courses.values())
+                for info in infos
+                if info is not None
+            ]
+        res += group
+    return res
+
+
+class TokenBucket:
+    """Caps the total download rate of every account at rate bytes per second.
+
+    Consumers may overdraw the bucket and then sleep until it refills, so
+    chunks larger than the burst size still pass.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    async def consume(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class Metrics:
+    """Request, retry, throughput and phase timing statistics of a sync.
+
+    They can be written as a JSON run report or in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.startTime = time.time()
+        self.requests = {}
+        self.retries = collections.Counter()
+        self.limiterWait = {"count": 0, "sum": 0.0}
+        self.phases = {}
+        self.courses = {}
+
+    def observeRequest(self, kind, latency, waited=0):
+        stats = self.requests.setdefault(
+            kind, {"count": 0, "sum": 0.0, "buckets": [0] * len(LATENCY_BUCKETS)}
+        )
+        stats["count"] += 1
+        stats["sum"] += latency
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                stats["buckets"][i] += 1
+        self.limiterWait["count"] += 1
+        self.limiterWait["sum"] += waited
+
+    def observeRetry(self, kind):
+        self.retries[kind] += 1
+
+    def merge(self, other):
+        for kind, stats in other.requests.items():
+            mine = self.requests.setdefault(
+                kind, {"count": 0, "sum": 0.0, "buckets": [0] * len(LATENCY_BUCKETS)}
+            )
+            mine["count"] += stats["count"]
+            mine["sum"] += stats["sum"]
+            mine["buckets"] = [a + b for a, b in zip(mine["buckets"], stats["buckets"])]
+        self.retries.update(other.retries)
+        self.limiterWait["count"] += other.limiterWait["count"]
+        self.limiterWait["sum"] += other.limiterWait["sum"]
+        # phases of parallel workers overlap, so the longest one is kept
+        for name, seconds in other.phases.items():
+            self.phases[name] = max(self.phases.get(name, 0), seconds)
+        self.courses.update(other.courses)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.monotonic() - start
+
+    def startCourseDownloads(self, course):
+        stats = self.courses.setdefault(course, {"bytes": 0, "files": 0})
+        stats.setdefault("start", time.monotonic())
+
+    def observeDownload(self, course, size):
+        self.startCourseDownloads(course)
+        stats = self.courses[course]
+        stats["bytes"] += size
+        stats["files"] += 1
+        stats["end"] = time.monotonic()
+
+    def report(self):
+        courses = {}
+        for course, stats in self.courses.items():
+            seconds = stats.get("end", stats["start"]) - stats["start"]
+            courses[course] = {
+                "bytes": stats["bytes"],
+                "files": stats["files"],
+                "bytesPerSecond": stats["bytes"] / seconds if seconds > 0 else 0,
+            }
+        wallTime = time.time() - self.startTime
+        downloadedBytes = sum(stats["bytes"] for stats in self.courses.values())
+        return {
+            "startTime": self.startTime,
+            "wallTime": wallTime,
+            "peakRss": peakRss(),
+            "requestCount": sum(stats["count"] for stats in self.requests.values()),
+            "downloadedBytes": downloadedBytes,
+            "bytesPerSecond": downloadedBytes / wallTime if wallTime > 0 else 0,
+            "requests": {
+                kind: {
+                    "count": stats["count"],
+                    "latencySum": stats["sum"],
+                    "latencyBuckets": dict(zip(LATENCY_BUCKETS, stats["buckets"])),
+                }
+                for kind, stats in self.requests.items()
+            },
+            "retries": dict(self.retries),
+            "limiterWait": self.limiterWait,
+            "phases": self.phases,
+            "courses": courses,
+        }
+
+    def prometheus(self):
+        lines = [
+            "# TYPE canvassyncer_request_duration_seconds histogram",
+        ]
+        for kind, stats in self.requests.items():
+            for bound, count in zip(LATENCY_BUCKETS, stats["buckets"]):
+                lines.append(
+                    "canvassyncer_request_duration_seconds_bucket"
+                    f'{{kind="{kind}",le="{bound}"}} {count}'
+                )
+            lines += [
+                "canvassyncer_request_duration_seconds_bucket"
+                f'{{kind="{kind}",le="+Inf"}} {stats["count"]}',
+                f'canvassyncer_request_duration_seconds_sum{{kind="{kind}"}} '
+                f'{stats["sum"]}',
+                f'canvassyncer_request_duration_seconds_count{{kind="{kind}"}} '
+                f'{stats["count"]}',
+            ]
+        lines.append("# TYPE canvassyncer_retries_total counter")
+        for kind, count in self.retries.items():
+            lines.append(f'canvassyncer_retries_total{{kind="{kind}"}} {count}')
+        lines += [
+            "# TYPE canvassyncer_limiter_wait_seconds summary",
+            f'canvassyncer_limiter_wait_seconds_sum {self.limiterWait["sum"]}',
+            f'canvassyncer_limiter_wait_seconds_count {self.limiterWait["count"]}',
+            "# TYPE canvassyncer_phase_seconds gauge",
+        ]
+        for name, seconds in self.phases.items():
+            lines.append(f'canvassyncer_phase_seconds{{phase="{name}"}} {seconds}')
+        if peakRss() is not None:
+            lines += [
+                "# TYPE canvassyncer_peak_rss_bytes gauge",
+                f"canvassyncer_peak_rss_bytes {peakRss()}",
+            ]
+        lines.append("# TYPE canvassyncer_downloaded_bytes_total counter")
+        for course, stats in self.courses.items():
+            lines.append(
+                f'canvassyncer_downloaded_bytes_total{{course="{course}"}} '
+                f'{stats["bytes"]}'
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, reportPath=None, metricsPath=None):
+        if reportPath:
+            with open(reportPath, mode="w", encoding="utf-8") as f:
+                json.dump(self.report(), f, indent=4, ensure_ascii=False)
+        if metricsPath:
+            with open(metricsPath, mode="w", encoding="utf-8") as f:
+                f.write(self.prometheus())
+
+
+def isThrottled(resp):
+    if resp.status_code == 429:
+        return True
+    if resp.status_code != 403:
+        return False
+    # canvas reports an exhausted rate limit quota with 403
+    try:
+        return "rate limit exceeded" in resp.text.lower()
+    except httpx.ResponseNotRead:
+        return resp.headers.get("x-rate-limit-remaining", "").startswith("0")
+
+
+def isRetryable(resp):
+    return resp.status_code >= 500 or isThrottled(resp)
+
+
+def isThrottledError(error):
+    if not isinstance(error, httpx.HTTPStatusError):
+        return False
+    return isThrottled(error.response) or "retry-after" in error.response.headers
+
+
+def backoffDelay(attempt):
+    return min(30, 0.1 * 2**attempt) * random.uniform(0.5, 1)
+
+
+def raiseForRetry(resp):
+    if isRetryable(resp):
+        raise httpx.HTTPStatusError(
+            f"Server responded {resp.status_code}",
+            request=resp.request,
+            response=resp,
+        )
+
+
+class AdaptiveLimiter:
+    """AIMD limit on the number of concurrent requests.
+
+    The limit grows by one after a window of healthy responses and is halved on
+    throttling, server errors and connection failures. Canvas's Retry-After and
+    X-Rate-Limit-Remaining headers are honoured as well. Free slots are handed
+    to the waiting owners (accounts) in round-robin order.
+    """
+
+    def __init__(self, maxLimit):
+        self.maxLimit = max(1, maxLimit)
+        self.limit = max(1, self.maxLimit // 2)
+        self.inflight = 0
+        self.successes = 0
+        self.latency = None
+        self.bestLatency = None
+        self.lastDecrease = 0
+        self.resumeAt = 0
+        self.waiters = {}
+
+    def slot(self, owner=None, trackLatency=True, metrics=None, kind=None):
+        return LimiterSlot(self, owner, trackLatency, metrics, kind)
+
+    async def acquire(self, owner=None):
+        if self.inflight < self.limit and not self.waiters:
+            self.inflight += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.waiters.setdefault(owner, collections.deque()).append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self.release()
+                raise
+        delay = self.resumeAt - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def release(self):
+        self.inflight -= 1
+        self.wakeup()
+
+    def wakeup(self):
+        while self.inflight < self.limit and self.waiters:
+            # dicts keep insertion order, re-adding an owner moves it last
+            owner = next(iter(self.waiters))
+            pending = self.waiters.pop(owner)
+            future = pending.popleft()
+            if pending:
+                self.waiters[owner] = pending
+            if future.cancelled():
+                continue
+            self.inflight += 1
+            future.set_result(None)
+
+    def increase(self, latency=None):
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            self.bestLatency = min(self.bestLatency or self.latency, self.latency)
+            # the server is slowing down, hold the limit
+            if self.latency > 2 * self.bestLatency:
+                return
+        self.successes += 1
+        if self.successes >= self.limit:
+            self.successes = 0
+            self.limit = min(self.maxLimit, self.limit + 1)
+            self.wakeup()
+
+    def decrease(self, retryAfter=0):
+        now = time.monotonic()
+        self.resumeAt = max(self.resumeAt, now + retryAfter)
+        self.successes = 0
+        # requests already in flight report the same congestion, halve once
+        if now - self.lastDecrease < 1:
+            return
+        self.lastDecrease = now
+        self.limit = max(1, self.limit // 2)
+
+    def observe(self, resp, latency=None):
+        if isRetryable(resp):
+            retryAfter = resp.headers.get("retry-after", "")
+            try:
+                self.decrease(float(retryAfter))
+            except ValueError:
+                self.decrease(1)
+            return
+        remaining = resp.headers.get("x-rate-limit-remaining")
+        try:
+            if remaining is not None and float(remaining) < LOW_RATE_LIMIT_QUOTA:
+                return self.decrease()
+        except ValueError:
+            pass
+        self.increase(latency)
+
+
+class LimiterSlot:
+    def __init__(self, limiter, owner, trackLatency, metrics, kind):
+        self.limiter = limiter
+        self.owner = owner
+        self.trackLatency = trackLatency
+        self.metrics = metrics
+        self.kind = kind
+        self.start = 0
+        self.waited = 0
+
+    async def __aenter__(self):
+        start = time.monotonic()
+        await self.limiter.acquire(self.owner)
+        self.start = time.monotonic()
+        self.waited = self.start - start
+        return self
+
+    async def __aexit__(self, excType, exc, tb):
+        if excType is not None and issubclass(excType, httpx.TransportError):
+            self.limiter.decrease()
+        self.limiter.release()
+        if self.metrics:
+            latency = time.monotonic() - self.start
+            self.metrics.observeRequest(self.kind, latency, self.waited)
+
+    def observe(self, resp):
+        latency = time.monotonic() - self.start if self.trackLatency else None
+        self.limiter.observe(resp, latency)
+
+
+class ResponseCache:
+    """On-disk cache of JSON responses validated with ETag/Last-Modified.
+
+    Entries are evicted in least recently used order once the cache grows
+    beyond maxSize bytes.
+    """
+
+    def __init__(self, cacheDir, maxSize, token):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.token = token
+        if not os.path.exists(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        entries = [
+            (entry.stat().st_mtime, entry.path, entry.stat().st_size)
+            for entry in os.scandir(self.cacheDir)
+            if entry.name.endswith(".json")
+        ]
+        # least recently used first, so eviction needs no stat calls
+        self.sizes = collections.OrderedDict(
+            (path, size) for _, path, size in sorted(entries)
+        )
+        self.totalSize = sum(self.sizes.values())
+        # entries are read and written from the filesystem threads
+        self.lock = threading.Lock()
+
+    def entryPath(self, url):
+        key = hashlib.sha256(f"{self.token}\n{url}".encode()).hexdigest()
+        return os.path.join(self.cacheDir, f"{key}.json")
+
+    def get(self, url):
+        path = self.entryPath(url)
+        try:
+            with open(path, mode="r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        return entry
+
+    def touch(self, url):
+        path = self.entryPath(url)
+        try:
+            os.utime(path)
+        except OSError:
+            return
+        with self.lock:
+            if path in self.sizes:
+                self.sizes.move_to_end(path)
+
+    def put(self, url, resp, body, links):
+        headers = {
+            "etag": resp.headers.get("etag"),
+            "lastModified": resp.headers.get("last-modified"),
+        }
+        if not headers["etag"] and not headers["lastModified"]:
+            return
+        path = self.entryPath(url)
+        data = json.dumps({"url": url, "body": body, "links": links, **headers})
+        tempPath = path + ".temp"
+        with open(tempPath, mode="w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tempPath, path)
+        with self.lock:
+            self.totalSize += len(data) - self.sizes.pop(path, 0)
+            self.sizes[path] = len(data)
+            self.evict()
+
+    def evict(self):
+        while self.totalSize > self.maxSize and self.sizes:
+            path, size = self.sizes.popitem(last=False)
+            self.totalSize -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def conditionalHeaders(entry):
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("lastModified"):
+            headers["If-Modified-Since"] = entry["lastModified"]
+        return headers
+
+
+class SharedPool:
+    """Connections, limiters and in-flight downloads shared by the clients of
+    every account synced in one process."""
+
+    def __init__(
+        self,
+        connectionCount,
+        proxy,
+        maxRate=0,
+        http2=False,
+        apiTimeout=5,
+        downloadTimeout=5,
+        keepalive=5,
+    ):
+        if http2 and importlib.util.find_spec("h2") is None:
+            print("HTTP/2 needs the h2 package: pip install canvassyncer[http2]")
+            http2 = False
+        # many small API requests can share a few multiplexed connections,
+        # while file downloads from the CDN get their own pool
+        self.client = self.createClient(
+            connectionCount, proxy, apiTimeout, keepalive, http2
+        )
+        self.downloadClient = self.createClient(
+            connectionCount, proxy, downloadTimeout, keepalive
+        )
+        self.apiLimiter = AdaptiveLimiter(connectionCount)
+        self.downloadLimiter = AdaptiveLimiter(connectionCount)
+        # downloads in flight, shared by the syncers of every account
+        self.downloads = {}
+        self.metrics = Metrics()
+        self.fs = FileSystem()
+        self.bandwidth = TokenBucket(maxRate) if maxRate else None
+
+    @staticmethod
+    def createClient(connectionCount, proxy, timeout, keepalive, http2=False):
+        limits = httpx.Limits(
+            max_connections=connectionCount,
+            max_keepalive_connections=connectionCount,
+            keepalive_expiry=keepalive,
+        )
+        return httpx.AsyncClient(
+            timeout=timeout,
             proxy=proxy,
-            transport=httpx.AsyncHTTPTransport(retries=3),
+            limits=limits,
+            http2=http2,
+            transport=httpx.AsyncHTTPTransport(retries=3, limits=limits, http2=http2),
             follow_redirects=True,
         )
 
-    async def downloadOne(self, src, dst):
-        async with self.sem:
-            async with self.client.stream("GET", src) as res:
+    async def aclose(self):
+        await self.client.aclose()
+        await self.downloadClient.aclose()
+        self.fs.shutdown()
+
+
+def poolOptions(config):
+    return {
+        "maxRate": config.get("max_rate", 0) * 1000000,
+        "http2": config.get("http2", False),
+        "apiTimeout": config.get("api_timeout", 5),
+        "downloadTimeout": config.get("download_timeout", 5),
+        "keepalive": config.get("keepalive", 5),
+    }
+
+
+def downloadKey(src, size):
+    # canvas serves a file under the same path to every account
+    _, netloc, path, _, _ = urlsplit(src)
+    return netloc, path, size
+
+
+class Progress:
+    """Aggregates the byte counters of the running downloads and refreshes
+    the display at a fixed rate instead of on every chunk.
+
+    Below the total bar, the course mode shows a bar per course and the file
+    mode one per running download. The json mode prints a line of counters
+    every JSON_PROGRESS_INTERVAL for logs of cron runs, quiet shows nothing.
+    """
+
+    def __init__(self, mode="bar", total=0):
+        self.mode = mode
+        self.total = total
+        self.done = 0
+        self.pending = 0
+        self.filesDone = 0
+        self.files = {}
+        self.filePending = {}
+        self.courses = {}
+        self.positions = []
+        self.startedAt = self.refreshedAt = time.monotonic()
+        self.reportedDone = None
+        self.interval = JSON_PROGRESS_INTERVAL if mode == "json" else PROGRESS_INTERVAL
+        self.bar = None
+        if mode in ("bar", "course", "file"):
+            self.bar = tqdm.tqdm(total=total, unit="B", unit_scale=True)
+
+    def addTotal(self, size):
+        self.total += size or 0
+        if self.bar is not None:
+            self.bar.total = self.total
+            self.bar.refresh()
+
+    def startFile(self, key, size, course=None):
+        if self.mode == "course":
+            bar = self.courses.get(course)
+            if bar is None:
+                bar = self.courses[course] = tqdm.tqdm(
+                    total=0,
+                    unit="B",
+                    unit_scale=True,
+                    desc=course,
+                    position=len(self.courses) + 1,
+                )
+            bar.total += size or 0
+            bar.refresh()
+            self.files[key] = bar
+        elif self.mode == "file":
+            position = self.positions.pop() if self.positions else len(self.files) + 1
+            self.files[key] = tqdm.tqdm(
+                total=size,
+                unit="B",
+                unit_scale=True,
+                desc=os.path.basename(key),
+                position=position,
+                leave=False,
+            )
+            self.files[key].canvasPosition = position
+
+    def update(self, n=1, key=None):
+        self.pending += n
+        if key in self.files:
+            self.filePending[key] = self.filePending.get(key, 0) + n
+        if time.monotonic() - self.refreshedAt >= self.interval:
+            self.flush()
+
+    def finishFile(self, key):
+        self.filesDone += 1
+        bar = self.files.pop(key, None)
+        if bar is None:
+            return
+        bar.update(self.filePending.pop(key, 0))
+        if self.mode == "file":
+            self.positions.append(bar.canvasPosition)
+            bar.close()
+
+    def flush(self, report=True):
+        self.done += self.pending
+        if self.bar is not None:
+            self.bar.update(self.pending)
+        self.pending = 0
+        for key, n in self.filePending.items():
+            self.files[key].update(n)
+        self.filePending.clear()
+        if report and self.mode == "json" and self.done != self.reportedDone:
+            self.report()
+        self.refreshedAt = time.monotonic()
+
+    def report(self, finished=False):
+        elapsed = time.monotonic() - self.startedAt
+        self.reportedDone = self.done
+        line = {
+            "downloaded": self.done,
+            "total": self.total,
+            "files": self.filesDone,
+            "bytesPerSecond": round(self.done / elapsed) if elapsed else 0,
+            "elapsed": round(elapsed, 1),
+        }
+        if finished:
+            line["finished"] = True
+        print(json.dumps(line), flush=True)
+
+    def write(self, text):
+        if self.bar is not None:
+            tqdm.tqdm.write(text)
+        else:
+            print(text)
+
+    def close(self):
+        self.flush(report=False)
+        if self.mode == "json":
+            self.report(finished=True)
+        for bar in [*self.files.values(), *self.courses.values()]:
+            bar.close()
+        if self.bar is not None:
+            self.bar.close()
+
+
+def progressMode(mode):
+    if mode == "auto":
+        return "bar" if sys.stderr.isatty() else "quiet"
+    return mode
+
+
+class QueueProgress:
+    """Stands in for the Progress of a --workers process and forwards its
+    counters to the Progress of the parent, at most every PROGRESS_INTERVAL."""
+
+    def __init__(self, queue, total=0):
+        self.queue = queue
+        self.pending = {}
+        self.sentAt = 0
+        self.addTotal(total)
+
+    def addTotal(self, size):
+        if size:
+            self.queue.put(("total", size))
+
+    def startFile(self, key, size, course=None):
+        self.queue.put(("start", (key, size, course)))
+
+    def update(self, n=1, key=None):
+        self.pending[key] = self.pending.get(key, 0) + n
+        if time.monotonic() - self.sentAt >= PROGRESS_INTERVAL:
+            self.flush()
+
+    def finishFile(self, key):
+        n = self.pending.pop(key, 0)
+        if n:
+            self.queue.put(("update", (n, key)))
+        self.queue.put(("finish", key))
+
+    def flush(self):
+        for key, n in self.pending.items():
+            if n:
+                self.queue.put(("update", (n, key)))
+        self.pending.clear()
+        self.sentAt = time.monotonic()
+
+    def write(self, text):
+        self.queue.put(("write", text))
+
+    def close(self):
+        self.flush()
+
+
+def showProgress(queue, mode):
+    # the parent's Progress for the downloads of every --workers process
+    progress = None
+    while True:
+        kind, value = queue.get()
+        if kind is None:
+            break
+        if progress is None:
+            progress = Progress(mode)
+        if kind == "total":
+            progress.addTotal(value)
+        elif kind == "start":
+            progress.startFile(*value)
+        elif kind == "update":
+            progress.update(*value)
+        elif kind == "finish":
+            progress.finishFile(value)
+        elif kind == "write":
+            progress.write(value)
+    if progress is not None:
+        progress.close()
+
+
+class AsyncSemClient:
+    def __init__(
+        self,
+        connectionCount,
+        token,
+        proxy,
+        cache=None,
+        splitSize=0,
+        splitCount=1,
+        pool=None,
+        poolOptions=None,
+    ):
+        self.ownsPool = pool is None
+        self.pool = pool or SharedPool(connectionCount, proxy, **(poolOptions or {}))
+        self.client = self.pool.client
+        self.downloadClient = self.pool.downloadClient
+        self.apiLimiter = self.pool.apiLimiter
+        self.downloadLimiter = self.pool.downloadLimiter
+        self.metrics = self.pool.metrics
+        self.fs = self.pool.fs
+        self.bandwidth = self.pool.bandwidth
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.cache = cache
+        self.failures = []
+        self.splitSize = splitSize
+        self.splitCount = splitCount
+        self.progressQueue = None
+        self.progressMode = "bar"
+        self.debug = False
+        self.chunkSize = CHUNK_SIZE * 1024
+
+    def withHeaders(self, headers=None):
+        return {**self.headers, **(headers or {})}
+
+    def apiSlot(self, kind):
+        return self.apiLimiter.slot(self, metrics=self.metrics, kind=kind)
+
+    def downloadSlot(self):
+        return self.downloadLimiter.slot(
+            self, trackLatency=False, metrics=self.metrics, kind="download"
+        )
+
+    async def downloadOne(self, src, dst, size=None, md5=None):
+        key = downloadKey(src, size)
+        pending = self.pool.downloads.get(key)
+        if pending is not None:
+            res = await asyncio.shield(pending)
+            if res is not None and await self.fs.run(os.path.exists, res[0]):
+                if res[0] != dst:
+                    await self.fs.run(linkFile, res[0], dst)
+                self.progress.update(size or 0, dst)
+                return res[1]
+        future = asyncio.get_running_loop().create_future()
+        self.pool.downloads[key] = future
+        digest = None
+        try:
+            digest = await self.downloadFile(src, dst, size, md5)
+        finally:
+            future.set_result((dst, digest) if digest else None)
+            # later syncs of the same file find it on disk or download it again
+            if self.pool.downloads.get(key) is future:
+                del self.pool.downloads[key]
+        return digest
+
+    async def downloadFile(self, src, dst, size=None, md5=None):
+        dst_temp = dst + ".temp"
+        split = (
+            size
+            and self.splitCount > 1
+            and size >= self.splitSize
+            and await self.fs.run(canSplit, dst_temp)
+        )
+        # the parts downloaded so far, kept across retries
+        splitState = {}
+        retryTimes = throttledTimes = 0
+        while retryTimes < DOWNLOAD_RETRIES:
+            try:
+                if split:
+                    digest = await self.downloadSplit(src, dst, size, md5, splitState)
+                    if digest is not None:
+                        return digest
+                    split = False
+                return await self.downloadStream(src, dst, size, md5)
+            except (httpx.HTTPError, IntegrityError) as e:
+                self.metrics.observeRetry("download")
+                # throttling only asks to come back later and does not use up
+                # the retries, the limiter also holds requests for Retry-After
+                if isThrottledError(e) and throttledTimes < THROTTLED_RETRIES:
+                    throttledTimes += 1
+                    await asyncio.sleep(backoffDelay(throttledTimes))
+                else:
+                    retryTimes += 1
+                if self.debug:
+                    self.progress.write(
+                        f"{e.__class__.__name__}. Retry."
+                        + f" {retryTimes + throttledTimes} times."
+                    )
+        self.failures.append(f"{src} => {dst}")
+
+    async def downloadStream(self, src, dst, size=None, md5=None):
+        dst_temp = dst + ".temp"
+        offset, validator = await self.fs.run(resumeState, dst_temp)
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+        async with self.downloadSlot() as slot:
+            async with self.downloadClient.stream(
+                "GET", src, headers=self.withHeaders(headers if validator else None)
+            ) as res:
+                slot.observe(res)
+                raiseForRetry(res)
+                if res.status_code == 416 and offset:
+                    return await self.commitResumed(dst, offset, size, md5, res)
                 if res.status_code >= 400:
                     return self.failures.append(f"{src} => {dst}")
+                if res.status_code != 206:
+                    offset = 0
+                validator = responseValidator(res)
+                if validator:
+                    await self.fs.run(writeValidator, dst_temp, validator)
+                if offset:
+                    hasher = await self.fs.run(fileMd5, dst_temp, offset)
+                else:
+                    hasher = hashlib.md5()
+                self.progress.update(offset, dst)
+                written = offset
                 num_bytes_downloaded = res.num_bytes_downloaded
-                dst_temp = dst + ".temp"
                 try:
-                    async with aiofiles.open(dst_temp, "+wb") as f:
-                        async for chunk in res.aiter_bytes():
+                    async with self.fs.open(
+                        dst_temp, "ab" if offset else "wb", md5=hasher
+                    ) as f:
+                        async for chunk in res.aiter_bytes(self.chunkSize):
+                            if self.bandwidth:
+                                await self.bandwidth.consume(len(chunk))
                             await f.write(chunk)
-                            self.tqdm.update(
-                                res.num_bytes_downloaded - num_bytes_downloaded
+                            written += len(chunk)
+                            self.progress.update(
+                                res.num_bytes_downloaded - num_bytes_downloaded, dst
                             )
                             num_bytes_downloaded = res.num_bytes_downloaded
                 except Exception as e:
-                    print(e.__class__.__name__)
-                    os.remove(dst_temp)
-                    return
-                os.rename(dst_temp, dst)
+                    # keep the partial file if it can be resumed later
+                    if not validator:
+                        await self.fs.run(os.remove, dst_temp)
+                    if isinstance(e, httpx.TransportError):
+                        raise
+                    self.progress.write(e.__class__.__name__)
+                    return self.failures.append(f"{src} => {dst}")
+        digest = hasher.hexdigest()
+        try:
+            checkIntegrity(dst, written, digest, size, md5)
+        except IntegrityError:
+            # a truncated or corrupt body cannot be resumed either
+            await self.fs.run(discardDownload, dst_temp)
+            raise
+        await self.fs.run(commitDownload, dst_temp, dst)
+        return digest
+
+    async def commitResumed(self, dst, offset, size, md5, res):
+        # a run stopped between the last write and the rename leaves a
+        # complete download behind, which has no bytes left to resume
+        dst_temp = dst + ".temp"
+        if size is None:
+            total = res.headers.get("content-range", "").rpartition("/")[2]
+            size = int(total) if total.isdigit() else None
+        digest = (await self.fs.run(fileMd5, dst_temp, offset)).hexdigest()
+        try:
+            checkIntegrity(dst, offset, digest, size, md5)
+        except IntegrityError:
+            # download it again from the start
+            await self.fs.run(discardDownload, dst_temp)
+            raise
+        self.progress.update(offset, dst)
+        await self.fs.run(commitDownload, dst_temp, dst)
+        return digest
+
+    async def downloadSplit(self, src, dst, size, md5, state):
+        dst_temp = dst + ".temp"
+        if not state:
+            # resume the parts of an interrupted run, or start them all
+            loaded = await self.fs.run(readSplitState, dst_temp, size)
+            if loaded is None:
+                async with self.fs.open(dst_temp, "wb", size=size):
+                    pass
+                partSize = -(-size // self.splitCount)
+                loaded = {
+                    "size": size,
+                    "validator": None,
+                    "parts": [
+                        [start, min(start + partSize, size) - 1]
+                        for start in range(0, size, partSize)
+                    ],
+                }
+                await self.fs.run(writeSplitState, dst_temp, loaded)
+            # parts save the state one at a time
+            state.update(loaded, lock=asyncio.Lock())
+            self.progress.update(
+                size - sum(end - start + 1 for start, end in state["parts"]), dst
+            )
+        pending = [part for part in state["parts"] if part[0] <= part[1]]
+        results = await asyncio.gather(
+            *[self.downloadPart(src, dst, state, part) for part in pending],
+            return_exceptions=True,
+        )
+        for res in results:
+            if isinstance(res, Exception) and not isinstance(
+                res, (httpx.HTTPError, IntegrityError, OSError)
+            ):
+                raise res
+        # fall back to a single stream if ranges are unsupported or the file
+        # changed between the parts
+        if False in results:
+            await self.fs.run(discardDownload, dst_temp)
+            state.clear()
+            return None
+        errors = [res for res in results if isinstance(res, Exception)]
+        if errors:
+            # only the failed ranges are downloaded again
+            raise errors[0]
+        digest = await self.fs.run(fileDigest, dst_temp)
+        try:
+            checkIntegrity(dst, size, digest, expectedMd5=md5)
+        except IntegrityError:
+            await self.fs.run(discardDownload, dst_temp)
+            state.clear()
+            raise
+        await self.fs.run(commitDownload, dst_temp, dst)
+        return digest
 
-    async def downloadMany(self, infos, totalSize=0):
-        self.tqdm = tqdm(total=totalSize, unit="B", unit_scale=True)
+    async def saveSplitState(self, dst_temp, state):
+        async with state["lock"]:
+            await self.fs.run(writeSplitState, dst_temp, state)
+
+    async def downloadPart(self, src, dst, state, part):
+        # part holds the next byte to download and the last byte of a range,
+        # the next byte only moves on once the data before it is on disk
+        dst_temp = dst + ".temp"
+        start, end = part
+        headers = {"Range": f"bytes={start}-{end}"}
+        if state["validator"]:
+            headers["If-Range"] = state["validator"]
+        async with self.downloadSlot() as slot:
+            async with self.downloadClient.stream(
+                "GET", src, headers=self.withHeaders(headers)
+            ) as res:
+                slot.observe(res)
+                raiseForRetry(res)
+                if res.status_code != 206:
+                    return False
+                validator = responseValidator(res) or ""
+                if state["validator"] is None:
+                    state["validator"] = validator
+                elif validator != state["validator"]:
+                    return False
+                num_bytes_downloaded = res.num_bytes_downloaded
+                written = start
+                f = self.fs.open(dst_temp, "r+b", offset=start)
+                try:
+                    async with f:
+                        async for chunk in res.aiter_bytes(self.chunkSize):
+                            chunk = chunk[: end + 1 - written]
+                            if self.bandwidth:
+                                await self.bandwidth.consume(len(chunk))
+                            await f.write(chunk)
+                            written += len(chunk)
+                            self.progress.update(
+                                res.num_bytes_downloaded - num_bytes_downloaded, dst
+                            )
+                            num_bytes_downloaded = res.num_bytes_downloaded
+                            if written - part[0] >= SPLIT_CHECKPOINT_SIZE:
+                                await f.checkpoint()
+                                part[0] = f.flushed
+                                await self.saveSplitState(dst_temp, state)
+                finally:
+                    part[0] = f.flushed
+                    await self.saveSplitState(dst_temp, state)
+                if written <= end:
+                    raise IntegrityError(
+                        f"Got {written - start} of {end + 1 - start}"
+                        f" bytes of a part: {dst}"
+                    )
+                return True
+
+    def startProgress(self, totalSize=0):
+        if self.progressQueue is not None:
+            self.progress = QueueProgress(self.progressQueue, totalSize)
+        else:
+            self.progress = Progress(progressMode(self.progressMode), totalSize)
         self.failures = []
+
+    def addProgressTotal(self, size):
+        self.progress.addTotal(size)
+
+    def finishProgress(self):
+        self.progress.close()
+        # the parent reports the failures of every --workers process
+        if self.progressQueue is None:
+            printFailures(self.failures)
+
+    async def downloadAndReport(self, info, onDone=None):
+        self.progress.startFile(info[1], info[2], info[4].get("course"))
+        try:
+            digest = await self.downloadOne(*info[:3], info[4].get("md5"))
+        finally:
+            self.progress.finishFile(info[1])
+        if digest and onDone:
+            await onDone(info, digest)
+
+    async def downloadWorker(self, queue, onDone=None):
+        while True:
+            info = await queue.get()
+            try:
+                if info is None:
+                    return
+                await self.downloadAndReport(info, onDone)
+            finally:
+                queue.task_done()
+
+    async def downloadMany(self, infos, totalSize=0, onDone=None):
+        # workers take the files in the given order as download slots free up
+        self.startProgress(totalSize)
+        queue = asyncio.Queue()
+        workerCount = min(len(infos), self.downloadLimiter.maxLimit)
+        for info in [*infos, *[None] * workerCount]:
+            queue.put_nowait(info)
         await asyncio.gather(
-            *[asyncio.create_task(self.downloadOne(src, dst)) for src, dst in infos]
+            *[self.downloadWorker(queue, onDone) for _ in range(workerCount)]
         )
-        self.tqdm.close()
-        if self.failures:
-            print(f"Fail to download these {len(self.failures)} file(s):")
-            for text in self.failures:
-                print(text)
+        self.finishProgress()
 
     async def json(self, *args, **kwargs):
-        retryTimes = 0
+        res, _ = await self.jsonWithLinks(*args, **kwargs)
+        return res
+
+    async def jsonWithLinks(self, url, **kwargs):
+        retryTimes = throttledTimes = 0
         checkError = bool(kwargs.pop("checkError", False))
         debugMode = bool(kwargs.pop("debug", False))
+        recordType = kwargs.pop("record", None)
+        cached = await self.fs.run(self.cache.get, url) if self.cache else None
+        if cached:
+            kwargs["headers"] = ResponseCache.conditionalHeaders(cached)
+        kwargs["headers"] = self.withHeaders(kwargs.get("headers"))
+        kind = endpointKind(url)
         while retryTimes <= 5:
             try:
-                async with self.sem:
-                    resp = await self.client.get(*args, **kwargs)
-                res = resp.json()
+                async with self.apiSlot(kind) as slot:
+                    async with self.client.stream("GET", url, **kwargs) as resp:
+                        if recordType and resp.status_code == 200:
+                            res = await readJsonRecords(resp, recordType)
+                        else:
+                            await resp.aread()
+                            res = None
+                    slot.observe(resp)
+                raiseForRetry(resp)
+                if cached and resp.status_code == 304:
+                    await self.fs.run(self.cache.touch, url)
+                    res = cached["body"]
+                    if recordType and isinstance(res, list):
+                        res = [recordType.fromJson(obj) for obj in res]
+                    return res, cached["links"]
+                if res is None:
+                    res = resp.json()
                 if checkError and isinstance(res, dict) and res.get("errors"):
                     errMsg = res["errors"][0].get("message", "unknown error.")
                     print(f"\nError: {errMsg}")
                     exit(1)
-                return res
+                if self.cache and resp.status_code == 200:
+                    body = res
+                    if recordType and isinstance(res, list):
+                        body = [r.toJson() if isinstance(r, Record) else r for r in res]
+                    await self.fs.run(self.cache.put, url, resp, body, resp.links)
+                return res, resp.links
             except Exception as e:
-                retryTimes += 1
+                if isThrottledError(e) and throttledTimes < THROTTLED_RETRIES:
+                    throttledTimes += 1
+                    await asyncio.sleep(backoffDelay(throttledTimes))
+                else:
+                    retryTimes += 1
+                self.metrics.observeRetry(kind)
                 if debugMode:
-                    print(f"{e.__class__.__name__}. Retry. {retryTimes} times.")
+                    print(
+                        f"{e.__class__.__name__}. Retry."
+                        + f" {retryTimes + throttledTimes} times."
+                    )
+        return None, {}
 
     async def head(self, *args, **kwargs):
-        async with self.sem:
+        kwargs["headers"] = self.withHeaders(kwargs.get("headers"))
+        async with self.apiSlot("head") as slot:
             resp = await self.client.head(*args, **kwargs)
+            slot.observe(resp)
         return resp.headers
 
     async def aclose(self):
-        await self.client.aclose()
+        if self.ownsPool:
+            await self.pool.aclose()
 
 
 class CanvasSyncer:
-    def __init__(self, config):
+    def __init__(self, config, pool=None):
         self.config = config
+        cache = None
+        if config.get("cache_dir"):
+            cache = ResponseCache(
+                config["cache_dir"], config["cache_size"] * 1000000, config["token"]
+            )
         self.client = AsyncSemClient(
-            config["connection_count"], config["token"], config.get("proxy")
+            config["connection_count"],
+            config["token"],
+            config.get("proxy"),
+            cache,
+            config.get("split_size", 0) * 1000000,
+            config.get("split_count", 1),
+            pool,
+            poolOptions(config),
         )
-        self.downloadSize = 0
-        self.laterDownloadSize = 0
+        self.client.progressMode = config.get("progress", "bar")
+        self.client.debug = config["debug"]
+        # 0 reads the chunks as they arrive from the network
+        self.client.chunkSize = config.get("chunk_size", CHUNK_SIZE) * 1024 or None
         self.courseCode = {}
+        self.courseSignals = {}
         self.baseUrl = self.config["canvasURL"] + "/api/v1"
         self.downloadDir = self.config["downloadDir"]
+        self.resetState()
+        if not os.path.exists(self.downloadDir):
+            os.mkdir(self.downloadDir)
+        self.index = SyncIndex(self.downloadDir, not config.get("shard"))
+        self.courseDirectory = CourseDirectory(
+            self.downloadDir,
+            self.baseUrl,
+            config["token"],
+            config.get("course_cache_ttl", 0) * 3600,
+        )
+
+    def resetState(self):
+        self.downloadSize = 0
+        self.laterDownloadSize = 0
         self.newInfo = []
         self.newFiles = []
         self.laterFiles = []
         self.laterInfo = []
         self.skipfiles = []
+        self.sizeSkippedFiles = []
         self.totalFileCount = 0
-        if not os.path.exists(self.downloadDir):
-            os.mkdir(self.downloadDir)
+        self.queue = None
+        self.dedupWaiting = {}
+        self.linkedCount = 0
+        self.pendingSignals = {}
+        self.pendingWatermarks = {}
+        self.movedFiles = []
+        self.movedCount = 0
+        self.resolving = {}
 
     async def aclose(self):
         await self.client.aclose()
 
-    async def dictFromPages(self, helperFunc, *args, **kwargs):
-        res = {}
-        page = 1
-        endOfPage = False
-        while not endOfPage:
-            pageRes = await asyncio.gather(
-                *[helperFunc(page + i, *args, **kwargs) for i in range(PAGES_PER_TIME)]
+    async def dictFromPages(
+        self, helperFunc, url, *args, checkError=False, record=None
+    ):
+        kwargs = {
+            "checkError": checkError,
+            "debug": self.config["debug"],
+            "record": record,
+        }
+        pageRes, links = await self.client.jsonWithLinks(
+            withQuery(url, per_page=PER_PAGE), **kwargs
+        )
+        res = helperFunc(pageRes, *args)
+        lastPage = pageNumber(links.get("last", {}).get("url", ""))
+        if "next" in links and lastPage is not None:
+            lastUrl = links["last"]["url"]
+            pagesRes = await asyncio.gather(
+                *[
+                    self.client.json(withQuery(lastUrl, page=page), **kwargs)
+                    for page in range(2, lastPage + 1)
+                ]
+            )
+            for pageRes in pagesRes:
+                res.update(helperFunc(pageRes, *args))
+            return res
+        while "next" in links:
+            pageRes, links = await self.client.jsonWithLinks(
+                links["next"]["url"], **kwargs
             )
-            for item in pageRes:
-                if not item:
-                    endOfPage = True
-                res.update(item)
-            page += PAGES_PER_TIME
+            res.update(helperFunc(pageRes, *args))
         return res
 
     def prepareLocalFiles(self, courseID, folders):
-        localFiles = []
+        localFiles = {}
         for folder in folders.values():
             if self.config["no_subfolder"]:
                 path = os.path.join(self.downloadDir, folder[1:])
@@ -140,41 +1842,57 @@ class CanvasSyncer:
                 path = os.path.join(
                     self.downloadDir, f"{self.courseCode[courseID]}{folder}"
                 )
-            if not os.path.exists(path):
-                os.makedirs(path)
-            localFiles += [
-                os.path.join(folder, f).replace("\\", "/").replace("//", "/")
-                for f in os.listdir(path)
-                if not os.path.isdir(os.path.join(path, f))
-            ]
+            try:
+                with os.scandir(path) as it:
+                    entries = [entry for entry in it if not entry.is_dir()]
+            except FileNotFoundError:
+                # a plan leaves the download directory untouched
+                if not self.config.get("plan"):
+                    os.makedirs(path)
+                continue
+            for entry in entries:
+                fileName = os.path.join(folder, entry.name)
+                fileName = fileName.replace("\\", "/").replace("//", "/")
+                # also caches the stat used to check the size of synced files
+                stat = entry.stat()
+                if self.isStaleTemp(courseID, fileName, entry, stat):
+                    if not self.config.get("plan"):
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+                    continue
+                localFiles[fileName] = entry
         return localFiles
 
-    async def getCourseFoldersWithIDHelper(self, page, courseID):
+    def isStaleTemp(self, courseID, fileName, entry, stat):
+        # partial downloads left by interrupted runs and not resumed for a while
+        if self.config.get("plan"):
+            return False
+        for suffix in (".etag", ".parts"):
+            if fileName.endswith(".temp" + suffix):
+                return not os.path.exists(entry.path[: -len(suffix)])
+        return (
+            fileName.endswith(".temp")
+            and time.time() - stat.st_mtime > TEMP_MAX_AGE
+            and self.index.get(self.getLocalPath(courseID, fileName)) is None
+        )
+
+    def getCourseFoldersWithIDHelper(self, folders):
         res = {}
-        url = f"{self.baseUrl}/courses/{courseID}/folders?page={page}"
-        retryTimes = 0
-        while retryTimes < 5:
-            try:
-                folders = await self.client.json(url, debug=self.config["debug"])
-                for folder in folders:
-                    if folder["full_name"].startswith("course files"):
-                        folder["full_name"] = folder["full_name"][len("course files") :]
-                    res[folder["id"]] = folder["full_name"]
-                    if not res[folder["id"]]:
-                        res[folder["id"]] = "/"
-                    res[folder["id"]] = re.sub(
-                        r"[\\\:\*\?\"\<\>\|]", "_", res[folder["id"]]
-                    )
-                return res
-            except Exception as e:
-                retryTimes = retryTimes + 1
-                if self.config["debug"]:
-                    print(str(retryTimes) + " time(s) error: " + str(e))
+        if not folders or isinstance(folders, dict):
+            return res
+        for folder in folders:
+            if folder["full_name"].startswith("course files"):
+                folder["full_name"] = folder["full_name"][len("course files") :]
+            res[folder["id"]] = folder["full_name"]
+            if not res[folder["id"]]:
+                res[folder["id"]] = "/"
+            res[folder["id"]] = re.sub(r"[\\\:\*\?\"\<\>\|]", "_", res[folder["id"]])
+        return res
 
-    async def getCourseFilesHelper(self, page, courseID, folders):
+    def getCourseFilesHelper(self, canvasFiles, folders):
         files = {}
-        url = f"{self.baseUrl}/courses/{courseID}/files?page={page}"
-        canvasFiles = await self.client.json(url, debug=self.config["debug"])
         if not canvasFiles or isinstance(canvasFiles, dict):
             return files
         for f in canvasFiles:
@@ -185,40 +1903,275 @@ class CanvasSyncer:
             path = path.replace("\\", "/").replace("//", "/")
             dt = datetime.strptime(f["modified_at"], "%Y-%m-%dT%H:%M:%SZ")
             modifiedTimeStamp = dt.replace(tzinfo=timezone.utc).timestamp()
-            files[path] = (f["url"], int(modifiedTimeStamp))
+            files[path] = {
+                "id": f["id"],
+                "url": f["url"],
+                "size": f.get("size"),
+                "modified_at": f["modified_at"],
+                "updated_at": f.get("updated_at"),
+                "md5": f.get("md5"),
+                "modifiedTimeStamp": int(modifiedTimeStamp),
+            }
         return files
 
+    async def getChangedCourseFiles(self, courseID, watermark, seen):
+        # newest first, so the listing stops at the first page with nothing
+        # newer than the watermark, except files updated within its second
+        # that the last listing did not see
+        def isNew(f):
+            updatedAt = f.get("updated_at") or ""
+            return updatedAt > watermark or (
+                updatedAt == watermark and f["id"] not in seen
+            )
+
+        url = withQuery(
+            f"{self.baseUrl}/courses/{courseID}/files",
+            sort="updated_at",
+            order="desc",
+            per_page=PER_PAGE,
+        )
+        changed = []
+        while url:
+            page, links = await self.client.jsonWithLinks(
+                url, debug=self.config["debug"], record=FileRecord
+            )
+            if not isinstance(page, list):
+                return None
+            new = [f for f in page if isNew(f)]
+            changed += new
+            if not new or (page[-1].get("updated_at") or "") < watermark:
+                break
+            url = links.get("next", {}).get("url")
+        folderRes = await asyncio.gather(
+            *[
+                self.client.json(
+                    f"{self.baseUrl}/folders/{folderID}", debug=self.config["debug"]
+                )
+                for folderID in {f["folder_id"] for f in changed}
+            ]
+        )
+        folders = self.getCourseFoldersWithIDHelper(
+            [f for f in folderRes if isinstance(f, dict) and "full_name" in f]
+        )
+        files = self.getCourseFilesHelper(changed, folders)
+        newWatermark = changed[0]["updated_at"] if changed else watermark
+        newSeen = [f["id"] for f in changed if f["updated_at"] == newWatermark]
+        if newWatermark == watermark:
+            newSeen += seen
+        return folders, files, newWatermark, newSeen
+
     async def getCourseFiles(self, courseID):
-        folders = await self.dictFromPages(self.getCourseFoldersWithIDHelper, courseID)
-        files = await self.dictFromPages(self.getCourseFilesHelper, courseID, folders)
+        record = self.index.getCourse(courseID)
+        if (
+            self.config.get("incremental")
+            and record is not None
+            and time.time() - record["listed_at"]
+            < self.config["full_listing_interval"] * 3600
+        ):
+            res = await self.getChangedCourseFiles(
+                courseID, record["watermark"], set(record.get("seen", []))
+            )
+            if res is not None:
+                folders, files, watermark, seen = res
+                self.pendingWatermarks[courseID] = {
+                    **record,
+                    "watermark": watermark,
+                    "seen": seen,
+                }
+                return folders, files
+        # a full listing also catches deleted files and renamed folders
+        listedAt = time.time()
+        folders = await self.dictFromPages(
+            self.getCourseFoldersWithIDHelper,
+            f"{self.baseUrl}/courses/{courseID}/folders",
+            record=FolderRecord,
+        )
+        files = await self.dictFromPages(
+            self.getCourseFilesHelper,
+            f"{self.baseUrl}/courses/{courseID}/files",
+            folders,
+            record=FileRecord,
+        )
+        updates = [f["updated_at"] for f in files.values() if f["updated_at"]]
+        if self.config.get("incremental") and updates:
+            watermark = max(updates)
+            self.pendingWatermarks[courseID] = {
+                "course_id": str(courseID),
+                "watermark": watermark,
+                # the files of the watermark second that are already synced
+                "seen": [
+                    f["id"] for f in files.values() if f["updated_at"] == watermark
+                ],
+                "listed_at": listedAt,
+            }
         return folders, files
 
-    async def getCourseIdByCourseCodeHelper(self, page, lowerCourseCodes):
-        res = {}
-        url = f"{self.baseUrl}/courses?page={page}"
-        courses = await self.client.json(
-            url, checkError=True, debug=self.config["debug"]
+    def getItemsHelper(self, items):
+        if not items or isinstance(items, dict):
+            return {}
+        return {item.get("id", item.get("page_id")): item for item in items}
+
+    async def getItems(self, url):
+        return list((await self.dictFromPages(self.getItemsHelper, url)).values())
+
+    async def discoverModules(self, courseID):
+        modules = await self.getItems(
+            withQuery(
+                f"{self.baseUrl}/courses/{courseID}/modules", **{"include[]": "items"}
+            )
         )
-        if not courses:
-            return res
-        for course in courses:
-            if course.get("course_code", "").lower() in lowerCourseCodes:
-                res[course["id"]] = course["course_code"]
-                lowerCourseCodes.remove(course.get("course_code", "").lower())
+        # canvas leaves out the items of large modules
+        missing = [module["items_url"] for module in modules if "items" not in module]
+        items = [item for module in modules for item in module.get("items") or []]
+        for moduleItems in await asyncio.gather(*map(self.getItems, missing)):
+            items += moduleItems
+        return {
+            item["content_id"]
+            for item in items
+            if item.get("type") == "File" and item.get("content_id")
+        }
+
+    async def discoverAssignments(self, courseID):
+        assignments = await self.getItems(
+            f"{self.baseUrl}/courses/{courseID}/assignments"
+        )
+        return {
+            fileID
+            for assignment in assignments
+            for fileID in linkedFileIDs(assignment.get("description"))
+        }
+
+    async def discoverPages(self, courseID):
+        pages = await self.getItems(
+            withQuery(
+                f"{self.baseUrl}/courses/{courseID}/pages", **{"include[]": "body"}
+            )
+        )
+        return {fileID for page in pages for fileID in linkedFileIDs(page.get("body"))}
+
+    async def discoverAnnouncements(self, courseID):
+        announcements = await self.getItems(
+            withQuery(
+                f"{self.baseUrl}/courses/{courseID}/discussion_topics",
+                only_announcements="true",
+            )
+        )
+        res = set()
+        for announcement in announcements:
+            res.update(linkedFileIDs(announcement.get("message")))
+            res.update(f["id"] for f in announcement.get("attachments") or [])
         return res
 
-    async def getCourseIdByCourseCode(self):
-        lowerCourseCodes = [s.lower() for s in self.config["courseCodes"]]
-        self.courseCode = await self.dictFromPages(
-            self.getCourseIdByCourseCodeHelper, lowerCourseCodes
+    async def resolveFile(self, courseID, fileID):
+        # every file is fetched once, however often it is referenced
+        pending = self.resolving.get(fileID)
+        if pending is None:
+            pending = self.resolving[fileID] = asyncio.ensure_future(
+                self.client.json(
+                    f"{self.baseUrl}/courses/{courseID}/files/{fileID}",
+                    debug=self.config["debug"],
+                )
+            )
+        return await asyncio.shield(pending)
+
+    async def discoverCourseFiles(self, courseID, folders, files):
+        """Adds the files referenced by the --discover sources of a course to
+        the listing, for courses that hide their files tab.
+
+        Files outside the listed folders go to their canvas folder if it can
+        be looked up, otherwise to a folder named after their first source.
+        """
+        sources = [s for s in DISCOVERY_SOURCES if s in self.config["discover"]]
+        refs = await asyncio.gather(
+            *[
+                getattr(self, f"discover{source.capitalize()}")(courseID)
+                for source in sources
+            ]
+        )
+        listed = {f["id"] for f in files.values()}
+        fileSources = {}
+        for source, fileIDs in zip(sources, refs):
+            for fileID in fileIDs:
+                if fileID not in listed:
+                    fileSources.setdefault(fileID, source)
+        resolved = await asyncio.gather(
+            *[self.resolveFile(courseID, fileID) for fileID in fileSources]
+        )
+        found = [
+            f
+            for f in resolved
+            if isinstance(f, dict) and "url" in f and "folder_id" in f
+        ]
+        folderRes = await asyncio.gather(
+            *[
+                self.client.json(
+                    f"{self.baseUrl}/folders/{folderID}", debug=self.config["debug"]
+                )
+                for folderID in {f["folder_id"] for f in found} - folders.keys()
+            ]
+        )
+        folders.update(
+            self.getCourseFoldersWithIDHelper(
+                [f for f in folderRes if isinstance(f, dict) and "full_name" in f]
+            )
         )
+        for f in found:
+            if f["folder_id"] not in folders:
+                source = fileSources[f["id"]]
+                folders[source] = f"/{source}"
+                f = {**f, "folder_id": source}
+            for path, fileInfo in self.getCourseFilesHelper([f], folders).items():
+                files.setdefault(path, fileInfo)
 
-    async def getCourseCodeByCourseIDHelper(self, courseID):
-        url = f"{self.baseUrl}/courses/{courseID}"
-        clientRes = await self.client.json(url, debug=self.config["debug"])
-        if clientRes.get("course_code") is None:
+    async def findCourses(self, lowerCourseCodes, **params):
+        # page through the courses only until every code is found
+        url = withQuery(
+            f"{self.baseUrl}/courses",
+            per_page=PER_PAGE,
+            **{"include[]": "term"},
+            **params,
+        )
+        found = {}
+        while url and len(found) < len(lowerCourseCodes):
+            courses, links = await self.client.jsonWithLinks(
+                url, checkError=True, debug=self.config["debug"]
+            )
+            if not courses or isinstance(courses, dict):
+                break
+            for course in courses:
+                self.courseDirectory.add(course)
+                code = course.get("course_code", "").lower()
+                if code in lowerCourseCodes and code not in found:
+                    found[code] = course
+            url = links.get("next", {}).get("url")
+        return found
+
+    async def getCourseIdByCourseCode(self):
+        missing = []
+        for code in dict.fromkeys(s.lower() for s in self.config["courseCodes"]):
+            record = self.courseDirectory.byCode(code)
+            if record is None:
+                missing.append(code)
+                continue
+            self.courseCode[record["id"]] = record["course_code"]
+        if not missing:
             return
-        self.courseCode[courseID] = clientRes["course_code"]
+        # current courses are few, so look there before the whole history
+        found = await self.findCourses(missing, enrollment_state="active")
+        if len(found) < len(missing):
+            found.update(await self.findCourses([c for c in missing if c not in found]))
+        for course in found.values():
+            self.courseCode[course["id"]] = course["course_code"]
+
+    async def getCourseCodeByCourseIDHelper(self, courseID):
+        record = self.courseDirectory.byID(courseID)
+        if record is None:
+            url = f"{self.baseUrl}/courses/{courseID}"
+            record = await self.client.json(url, debug=self.config["debug"])
+            if not isinstance(record, dict) or record.get("course_code") is None:
+                return
+            self.courseDirectory.add(record)
+        self.courseCode[courseID] = record["course_code"]
 
     async def getCourseCodeByCourseID(self):
         await asyncio.gather(
@@ -235,52 +2188,231 @@ class CanvasSyncer:
         if self.config.get("courseIDs"):
             coros.append(self.getCourseCodeByCourseID())
         await asyncio.gather(*coros)
+        self.courseDirectory.save()
 
-    async def getCourseTaskInfoHelper(
-        self, courseID, localFiles, fileName, fileUrl, fileModifiedTimeStamp
-    ):
-        if not fileUrl:
-            return
+    def getLocalPath(self, courseID, fileName):
         if self.config["no_subfolder"]:
-            path = os.path.join(self.downloadDir, fileName[1:])
-        else:
-            path = os.path.join(
-                self.downloadDir, f"{self.courseCode[courseID]}{fileName}"
+            return fileName[1:]
+        return f"{self.courseCode[courseID]}{fileName}".replace("//", "/")
+
+    def isIndexedUpToDate(self, relPath, fileInfo):
+        # local edits, e.g. annotations, are kept until canvas has a new version
+        record = self.index.get(relPath)
+        return (
+            record is not None
+            and not record.get("corrupt")
+            and record.get("id") == fileInfo["id"]
+            and record.get("size") == fileInfo["size"]
+            and record.get("modified_at") == fileInfo["modified_at"]
+        )
+
+    def indexRecord(self, relPath, fileInfo, digest=None):
+        return {
+            "path": relPath,
+            "id": fileInfo["id"],
+            "size": fileInfo["size"],
+            "modified_at": fileInfo["modified_at"],
+            "updated_at": fileInfo["updated_at"],
+            "md5": digest,
+        }
+
+    async def updateIndex(self, record):
+        # the log is appended and compacted in the filesystem threads
+        self.index.remember(record)
+        await self.client.fs.run(self.index.append, record)
+
+    async def findLocalCopy(self, digest, size, relPath):
+        record = self.index.findDigest(digest, size)
+        if record is None or record["path"] == relPath:
+            return None
+        path = os.path.join(self.downloadDir, record["path"])
+        return path if await self.client.fs.run(os.path.exists, path) else None
+
+    async def linkDuplicate(self, src, info, digest):
+        _, path, _, relPath, fileInfo = info
+        try:
+            await self.client.fs.run(linkFile, src, path)
+        except OSError as e:
+            print(f"{e.__class__.__name__}! Failed to link {path}")
+            return False
+        await self.updateIndex(self.indexRecord(relPath, fileInfo, digest))
+        self.linkedCount += 1
+        return True
+
+    async def dedupFile(self, info):
+        _, _, fileSize, relPath, fileInfo = info
+        digest = fileInfo.get("md5")
+        if not isMd5(digest):
+            return False
+        src = await self.findLocalCopy(digest, fileSize, relPath)
+        if src is not None:
+            return await self.linkDuplicate(src, info, digest)
+        # the same content is already scheduled, link it once downloaded
+        if digest in self.dedupWaiting:
+            self.dedupWaiting[digest].append(info)
+            return True
+        self.dedupWaiting[digest] = []
+        return False
+
+    async def onDownloaded(self, info, digest):
+        _, path, fileSize, relPath, fileInfo = info
+        if self.config.get("dedup"):
+            src = await self.findLocalCopy(digest, fileSize, relPath)
+            if src is not None:
+                await self.linkDuplicate(src, info, digest)
+            if fileInfo.get("md5") == digest:
+                for waiting in self.dedupWaiting.pop(digest, []):
+                    await self.linkDuplicate(path, waiting, digest)
+        await self.updateIndex(self.indexRecord(relPath, fileInfo, digest))
+        self.client.metrics.observeDownload(fileInfo["course"], fileSize)
+
+    async def downloadDedupLeftovers(self):
+        # duplicates whose first copy failed to download or was filtered out
+        leftovers = [
+            info
+            for infos in self.dedupWaiting.values()
+            for info in infos
+            if self.checkAllowDownload(info[1])
+        ]
+        self.dedupWaiting = {}
+        if leftovers:
+            await self.client.downloadMany(
+                leftovers, sum(info[2] for info in leftovers), self.onDownloaded
             )
-        path = path.replace("\\", "/").replace("//", "/")
-        if fileName in localFiles and fileModifiedTimeStamp <= os.path.getctime(path):
+        if self.linkedCount:
+            print(f"Linked {self.linkedCount} duplicate file(s)!")
+
+    async def getCourseTaskInfoHelper(self, courseID, localEntry, fileName, fileInfo):
+        fileUrl = fileInfo["url"]
+        if not fileUrl:
             return
-        response = await self.client.head(fileUrl)
-        fileSize = int(response.get("content-length", 0))
-        if fileName in localFiles:
-            self.laterDownloadSize += fileSize
-            self.laterFiles.append((fileUrl, path))
-            self.laterInfo.append(
-                f"{self.courseCode[courseID]}{fileName} ({round(fileSize / 1000000, 2)}MB)"
-            )
+        relPath = self.getLocalPath(courseID, fileName)
+        path = os.path.join(self.downloadDir, relPath).replace("\\", "/")
+        fileInfo["course"] = self.courseCode[courseID]
+        corrupt = False
+        if localEntry is not None:
+            if self.isIndexedUpToDate(relPath, fileInfo):
+                return
+            record = self.index.get(relPath)
+            # --verify found the local copy corrupt, it is replaced in place
+            corrupt = record is not None and bool(record.get("corrupt"))
+            if record is None:
+                # the file predates the index, trust its timestamp once, the
+                # stat is cached by the folder scan
+                if fileInfo["modifiedTimeStamp"] <= localEntry.stat().st_ctime:
+                    if not self.config.get("plan"):
+                        await self.updateIndex(self.indexRecord(relPath, fileInfo))
+                    return
+        elif await self.moveRenamed(relPath, path, fileInfo):
             return
-        if fileSize > self.config["filesizeThresh"] * 1000000:
-            aiofiles.open(path, "w").close()
-            self.skipfiles.append(
-                f"{self.courseCode[courseID]}{fileName} ({round(fileSize / 1000000, 2)}MB)"
-            )
+        fileSize = fileInfo["size"]
+        # a plan is made from the listing alone, sizes may stay unknown
+        if fileSize is None and not self.config.get("plan"):
+            response = await self.client.head(fileUrl)
+            fileSize = fileInfo["size"] = int(response.get("content-length", 0))
+        info = (fileUrl, path, fileSize, relPath, fileInfo)
+        description = (
+            f"{self.courseCode[courseID]}{fileName}"
+            + f" ({round((fileSize or 0) / 1000000, 2)}MB"
+            + (", corrupt)" if corrupt else ")")
+        )
+        if localEntry is not None and not corrupt:
+            self.laterDownloadSize += fileSize or 0
+            self.laterFiles.append(info)
+            self.laterInfo.append(description)
+            return
+        if fileSize is not None and fileSize > self.config["filesizeThresh"] * 1000000:
+            self.skipfiles.append(description)
+            self.sizeSkippedFiles.append(info)
             return
-        self.newInfo.append(
-            f"{self.courseCode[courseID]}{fileName} ({round(fileSize / 1000000, 2)}MB)"
+        if (
+            self.config.get("dedup")
+            and not self.config.get("plan")
+            and not corrupt
+            and await self.dedupFile(info)
+        ):
+            return
+        self.newInfo.append(description)
+        self.downloadSize += fileSize or 0
+        if self.queue is None:
+            self.newFiles.append(info)
+        elif self.checkAllowDownload(path):
+            self.client.metrics.startCourseDownloads(fileInfo["course"])
+            self.client.addProgressTotal(fileSize)
+            self.client.progress.write(f"Download {self.newInfo[-1]}")
+            await self.queue.put(info)
+
+    def findRenamed(self, relPath, fileInfo):
+        # the same canvas file synced before under another path
+        record = self.index.findID(fileInfo["id"])
+        if (
+            record is None
+            or record["path"] == relPath
+            or record.get("corrupt")
+            or record["modified_at"] != fileInfo["modified_at"]
+            or fileInfo["size"] not in (None, record["size"])
+        ):
+            return None
+        return record
+
+    async def moveIndexed(self, record, relPath, path, fileInfo):
+        src = os.path.join(self.downloadDir, record["path"])
+        try:
+            await self.client.fs.run(moveFile, src, path)
+        except OSError:
+            return False
+        if fileInfo["size"] is None:
+            fileInfo["size"] = record["size"]
+        await self.updateIndex({"path": record["path"], "deleted": True})
+        await self.updateIndex(self.indexRecord(relPath, fileInfo, record["md5"]))
+        self.movedCount += 1
+        return True
+
+    async def moveRenamed(self, relPath, path, fileInfo):
+        record = self.findRenamed(relPath, fileInfo)
+        if record is None:
+            return False
+        if not self.config.get("plan"):
+            return await self.moveIndexed(record, relPath, path, fileInfo)
+        src = os.path.join(self.downloadDir, record["path"])
+        if not await self.client.fs.run(os.path.exists, src):
+            return False
+        if fileInfo["size"] is None:
+            fileInfo["size"] = record["size"]
+        info = (fileInfo["url"], path, fileInfo["size"], relPath, fileInfo)
+        self.movedFiles.append((record["path"], info))
+        return True
+
+    async def courseChanged(self, courseID):
+        # the most recently updated file is a cheap signal for any change
+        url = withQuery(
+            f"{self.baseUrl}/courses/{courseID}/files",
+            sort="updated_at",
+            order="desc",
+            per_page=1,
         )
-        self.downloadSize += fileSize
-        self.newFiles.append((fileUrl, path))
+        latest = await self.client.json(url, debug=self.config["debug"])
+        if not isinstance(latest, list):
+            return True
+        signal = [[f["id"], f.get("updated_at")] for f in latest]
+        self.pendingSignals[courseID] = signal
+        return self.courseSignals.get(courseID) != signal
 
     async def getCourseTaskInfo(self, courseID):
+        if self.config.get("watch") and not await self.courseChanged(courseID):
+            return
         folders, files = await self.getCourseFiles(courseID)
+        if self.config.get("discover"):
+            await self.discoverCourseFiles(courseID, folders, files)
         self.totalFileCount += len(files)
-        localFiles = self.prepareLocalFiles(courseID, folders)
+        # one filesystem job scans every folder of the course
+        localFiles = await self.client.fs.run(self.prepareLocalFiles, courseID, folders)
         await asyncio.gather(
             *[
                 self.getCourseTaskInfoHelper(
-                    courseID, localFiles, fileName, fileUrl, fileModifiedTimeStamp
+                    courseID, localFiles.get(fileName), fileName, fileInfo
                 )
-                for fileName, (fileUrl, fileModifiedTimeStamp) in files.items()
+                for fileName, fileInfo in files.items()
             ]
         )
 
@@ -305,10 +2437,13 @@ class CanvasSyncer:
             print(s)
         isDownload = "Y" if self.config["y"] else input("Update all?(Y/n) ")
         if isDownload in ["n", "N"]:
+            self.laterFiles = []
+            # offer the declined files again on the next run
+            self.pendingWatermarks = {}
             return
         print(f"Start to download {len(self.laterInfo)} file(s)!")
         laterFiles = []
-        for fileUrl, path in self.laterFiles:
+        for fileUrl, path, fileSize, relPath, fileInfo in self.laterFiles:
             localCreatedTimeStamp = int(os.path.getctime(path))
             try:
                 newPath = os.path.join(
@@ -324,67 +2459,280 @@ class CanvasSyncer:
                         ntpath.dirname(path),
                         f"{int(time.time())}_{ntpath.basename(path)}",
                     )
-                laterFiles.append((fileUrl, path))
+                    relPath = os.path.relpath(path, self.downloadDir).replace("\\", "/")
+                laterFiles.append((fileUrl, path, fileSize, relPath, fileInfo))
             except Exception as e:
                 print(f"{e.__class__.__name__}! Skipped: {path}")
         self.laterFiles = laterFiles
 
+    def isAllowedType(self, filename):
+        category = fileCategory(filename)
+        return category == "other" or self.config[f"allow{category.capitalize()}"]
+
     def checkAllowDownload(self, filename):
-        fileType = (mimetypes.guess_type(filename))[0]
-        if fileType is None:
+        if self.isAllowedType(filename):
             return True
-        if not self.config["allowAudio"]:
-            if fileType.split("/")[0] == "audio":
-                print(
-                    f"Remove {filename} from the download list because of its file type: audio."
-                )
-                return False
-        if not self.config["allowVideo"]:
-            if fileType.split("/")[0] == "video":
-                print(
-                    f"Remove {filename} the download list because of its file type: video."
-                )
-                return False
-        if not self.config["allowImage"]:
-            if fileType.split("/")[0] == "image":
-                print(
-                    f"Remove {filename} the download list because of its file type: image."
-                )
-                return False
-        return True
+        print(
+            f"Remove {filename} from the download list"
+            + f" because of its file type: {fileCategory(filename)}."
+        )
+        return False
 
     def checkFilesType(self):
         self.laterFiles = [
-            (fileUrl, path)
-            for (fileUrl, path) in self.laterFiles
-            if self.checkAllowDownload(path)
+            info for info in self.laterFiles if self.checkAllowDownload(info[1])
         ]
         self.newFiles = [
-            (fileUrl, path)
-            for (fileUrl, path) in self.newFiles
-            if self.checkAllowDownload(path)
+            info for info in self.newFiles if self.checkAllowDownload(info[1])
         ]
 
-    async def sync(self):
+    async def prepareCourses(self):
+        # course IDs resolved by an earlier run in watch mode are kept
+        if self.courseCode:
+            return
         print("Getting course IDs...")
-        await self.getCourseID()
+        with self.client.metrics.phase("getCourseID"):
+            await self.getCourseID()
         print(f"Get {len(self.courseCode)} available courses!")
+
+    async def findFiles(self):
+        with self.client.metrics.phase("getCourseTaskInfo"):
+            await asyncio.gather(
+                *[
+                    asyncio.create_task(self.getCourseTaskInfo(courseID))
+                    for courseID in self.courseCode.keys()
+                ]
+            )
+        if self.movedCount:
+            print(f"Moved {self.movedCount} file(s) renamed on canvas!")
+
+    def finishRun(self):
+        # courses with failed downloads are checked again on the next run
+        if self.client.failures:
+            return
+        self.courseSignals.update(self.pendingSignals)
+        for courseID, record in self.pendingWatermarks.items():
+            if record != self.index.getCourse(courseID):
+                self.index.updateCourse(record)
+
+    def writeMetrics(self):
+        self.client.metrics.write(self.config.get("report"), self.config.get("metrics"))
+
+    async def sync(self):
+        if self.config.get("pipeline"):
+            return await self.syncPipelined()
+        await self.prepareCourses()
         print("Finding files on canvas...")
-        await asyncio.gather(
-            *[
-                asyncio.create_task(self.getCourseTaskInfo(courseID))
-                for courseID in self.courseCode.keys()
-            ]
-        )
+        await self.findFiles()
         print(f"Get {self.totalFileCount} files!")
         if not self.newFiles and not self.laterFiles:
+            if self.linkedCount:
+                print(f"Linked {self.linkedCount} duplicate file(s)!")
             return print("All local files are synced!")
+        await self.downloadFiles()
+
+    async def verify(self):
+        records = [record for record in self.index.records.values() if record["md5"]]
+        print(f"Verifying {len(records)} file(s)...")
+        paths = [os.path.join(self.downloadDir, record["path"]) for record in records]
+        loop = asyncio.get_running_loop()
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            results = await loop.run_in_executor(
+                None,
+                lambda: list(
+                    executor.map(verifyFile, paths, chunksize=VERIFY_CHUNKSIZE)
+                ),
+            )
+        corrupt = [
+            record
+            for record, res in zip(records, results)
+            if res is not None
+            and (res[1] != record["md5"] or record["size"] not in (None, res[0]))
+        ]
+        if not corrupt:
+            return print("All verified files are intact!")
+        print(f"These {len(corrupt)} file(s) are corrupt and will be downloaded again:")
+        for record in corrupt:
+            print(record["path"])
+            await self.updateIndex({**record, "corrupt": True})
+
+    async def downloadFiles(self):
         self.checkNewFiles()
-        self.checkLaterFiles()
+        # older versions are renamed off the event loop of other accounts
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.checkLaterFiles)
         self.checkFilesType()
-        await self.client.downloadMany(
-            self.newFiles + self.laterFiles, self.downloadSize + self.laterDownloadSize
+        for info in self.newFiles + self.laterFiles:
+            self.client.metrics.startCourseDownloads(info[4]["course"])
+        with self.client.metrics.phase("downloadMany"):
+            await self.client.downloadMany(
+                scheduleDownloads(
+                    self.newFiles + self.laterFiles,
+                    self.config.get("order", "listing"),
+                    self.config.get("type_priority"),
+                ),
+                self.downloadSize + self.laterDownloadSize,
+                self.onDownloaded,
+            )
+            await self.downloadDedupLeftovers()
+
+    def planEntry(self, action, info):
+        fileUrl, _, fileSize, relPath, fileInfo = info
+        entry = {"action": action, "path": relPath, "url": fileUrl}
+        entry.update({key: fileInfo.get(key) for key in PLAN_FIELDS})
+        entry["size"] = fileSize
+        return entry
+
+    async def plan(self, planPath):
+        await self.prepareCourses()
+        print("Finding files on canvas...")
+        await self.findFiles()
+        print(f"Get {self.totalFileCount} files!")
+        entries = []
+        for action, infos in [("new", self.newFiles), ("update", self.laterFiles)]:
+            for info in infos:
+                allowed = self.isAllowedType(info[1])
+                entries.append(self.planEntry(action if allowed else "skip-type", info))
+        entries += [self.planEntry("skip-size", info) for info in self.sizeSkippedFiles]
+        entries += [
+            {**self.planEntry("move", info), "from": src}
+            for src, info in self.movedFiles
+        ]
+        courses = {}
+        for entry in entries:
+            stats = courses.setdefault(
+                entry["course"], {"action": "course", "course": entry["course"]}
+            )
+            stats.setdefault(entry["action"], 0)
+            stats[entry["action"]] += 1
+            if entry["action"] in ("new", "update"):
+                stats["bytes"] = stats.get("bytes", 0) + (entry["size"] or 0)
+        with open(planPath, mode="w", encoding="utf-8") as f:
+            for entry in [*entries, *courses.values()]:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        planned = [entry for entry in entries if entry["action"] in ("new", "update")]
+        if self.movedFiles:
+            print(f"Planned {len(self.movedFiles)} move(s) of renamed file(s)!")
+        size = sum(entry["size"] or 0 for entry in planned)
+        print(
+            f"Planned {len(planned)} file(s) ({round(size / 1000000, 2)}MB)"
+            + f" to {planPath}!"
+        )
+
+    async def apply(self, planPath):
+        with open(planPath, mode="r", encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        for entry in entries:
+            if entry["action"] not in ("new", "update", "move"):
+                continue
+            relPath = entry["path"]
+            path = os.path.join(self.downloadDir, relPath).replace("\\", "/")
+            fileInfo = {key: entry[key] for key in PLAN_FIELDS}
+            exists = await self.client.fs.run(os.path.exists, path)
+            # entries synced since the plan was made, e.g. by an earlier apply
+            if exists and self.isIndexedUpToDate(relPath, fileInfo):
+                continue
+            # a move whose source is gone is downloaded instead
+            if entry["action"] == "move" and not exists:
+                record = self.index.get(entry["from"]) or {
+                    "path": entry["from"],
+                    "size": entry["size"],
+                    "md5": entry["md5"],
+                }
+                if await self.moveIndexed(record, relPath, path, fileInfo):
+                    continue
+            if fileInfo["size"] is None:
+                response = await self.client.head(entry["url"])
+                fileInfo["size"] = int(response.get("content-length", 0))
+            info = (entry["url"], path, fileInfo["size"], relPath, fileInfo)
+            description = f"{relPath} ({round(fileInfo['size'] / 1000000, 2)}MB)"
+            if exists:
+                self.laterDownloadSize += fileInfo["size"]
+                self.laterFiles.append(info)
+                self.laterInfo.append(description)
+                continue
+            await self.client.fs.run(os.makedirs, os.path.dirname(path), 0o777, True)
+            if self.config.get("dedup") and await self.dedupFile(info):
+                continue
+            self.newInfo.append(description)
+            self.downloadSize += fileInfo["size"]
+            self.newFiles.append(info)
+        if self.movedCount:
+            print(f"Moved {self.movedCount} file(s) renamed on canvas!")
+        if not self.newFiles and not self.laterFiles:
+            if self.linkedCount:
+                print(f"Linked {self.linkedCount} duplicate file(s)!")
+            return print("All planned files are synced!")
+        await self.downloadFiles()
+
+    async def syncPipelined(self):
+        await self.prepareCourses()
+        print("Finding and downloading files on canvas...")
+        workerCount = self.config["connection_count"]
+        self.queue = asyncio.Queue(maxsize=workerCount * 2)
+        self.client.startProgress()
+        downloadStart = time.monotonic()
+        workers = [
+            asyncio.create_task(
+                self.client.downloadWorker(self.queue, self.onDownloaded)
+            )
+            for _ in range(workerCount)
+        ]
+        await self.findFiles()
+        self.client.progress.write(f"Get {self.totalFileCount} files!")
+        # the prompt blocks, so ask it in a thread while new files keep flowing
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.checkLaterFiles)
+        self.newFiles = self.laterFiles
+        self.laterFiles = []
+        self.checkFilesType()
+        self.client.addProgressTotal(sum(info[2] for info in self.newFiles))
+        for info in self.newFiles:
+            self.client.metrics.startCourseDownloads(info[4]["course"])
+            await self.queue.put(info)
+        for _ in workers:
+            await self.queue.put(None)
+        await asyncio.gather(*workers)
+        self.client.finishProgress()
+        self.newFiles = []
+        await self.downloadDedupLeftovers()
+        phases = self.client.metrics.phases
+        phases["downloadMany"] = (
+            phases.get("downloadMany", 0) + time.monotonic() - downloadStart
         )
+        if not self.newInfo and not self.laterInfo:
+            return print("All local files are synced!")
+        self.checkNewFiles()
+
+    async def watch(self, interval):
+        while True:
+            try:
+                await self.sync()
+                self.finishRun()
+            except Exception as e:
+                printUnexpectedError(e, self.config["debug"])
+            self.writeMetrics()
+            delay = interval * random.uniform(0.9, 1.1)
+            print(f"Next sync in {int(delay)} seconds...")
+            await asyncio.sleep(delay)
+            self.resetState()
+
+
+def printFailures(failures):
+    if failures:
+        print(f"Fail to download these {len(failures)} file(s):")
+        for text in failures:
+            print(text)
+
+
+def printUnexpectedError(e, debug):
+    errorName = e.__class__.__name__
+    print(
+        f"Unexpected error: {errorName}. Please check your network and token!"
+        + ("" if debug else " Or use -d for detailed information.")
+    )
+    if debug:
+        print(traceback.format_exc())
 
 
 def initConfig():
@@ -470,7 +2818,17 @@ def initConfig():
     }
 
 
-def getConfig():
+def typePriorityArg(value):
+    category, _, priority = value.partition("=")
+    if category not in FILE_CATEGORIES:
+        raise argparse.ArgumentTypeError(f"unknown file type: {category}")
+    try:
+        return category, int(priority)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid priority: {value}") from None
+
+
+def argumentParser():
     parser = argparse.ArgumentParser(description="A Simple Canvas File Syncer")
     parser.add_argument("-r", help="recreate config file", action="store_true")
     parser.add_argument("-y", help="confirm all prompts", action="store_true")
@@ -499,7 +2857,178 @@ def getConfig():
         help="do not keep older version",
         action="store_true",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--cache-dir",
+        help="directory to cache canvas listings in",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="max size of the listing cache in MB",
+        default=100,
+        type=float,
+    )
+    parser.add_argument(
+        "--split-size",
+        help="download files larger than this (MB) in several parts",
+        default=100,
+        type=float,
+    )
+    parser.add_argument(
+        "--split-count",
+        help="number of parts to download a large file in",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--pipeline",
+        help="start downloading while still finding files on canvas",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--discover",
+        help="also sync the files referenced by these sources, for courses "
+        + f"that hide their files tab; sources are {', '.join(DISCOVERY_SOURCES)}",
+        default=[],
+        choices=DISCOVERY_SOURCES,
+        metavar="SOURCE",
+        nargs="+",
+    )
+    parser.add_argument(
+        "--dedup",
+        help="hardlink identical files instead of storing copies",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--watch",
+        help="sync again every INTERVAL seconds, implies -y",
+        metavar="INTERVAL",
+        default=None,
+        type=float,
+    )
+    parser.add_argument(
+        "--report", help="write a JSON report of the sync here", default=None
+    )
+    parser.add_argument(
+        "--metrics",
+        help="write sync metrics in the Prometheus text format here",
+        default=None,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="only list files changed on canvas since the last sync",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--full-listing-interval",
+        help="list all files of a course again after this many hours, with --incremental",
+        metavar="HOURS",
+        default=24,
+        type=float,
+    )
+    parser.add_argument(
+        "--order",
+        help="order to download files in: as listed, smallest or newest first, "
+        + "or round-robin across courses",
+        choices=DOWNLOAD_ORDERS,
+        default="listing",
+    )
+    parser.add_argument(
+        "--type-priority",
+        help="download file types with a lower priority first, e.g. video=1; "
+        + f"types are {', '.join(FILE_CATEGORIES)}",
+        metavar="TYPE=PRIORITY",
+        nargs="+",
+        default=[],
+        type=typePriorityArg,
+    )
+    parser.add_argument(
+        "--max-rate",
+        help="cap the total download rate at this many MB/s",
+        default=0,
+        type=float,
+    )
+    parser.add_argument(
+        "--course-cache-ttl",
+        help="reuse the course codes and IDs found on canvas for this many hours",
+        metavar="HOURS",
+        default=24,
+        type=float,
+    )
+    parser.add_argument(
+        "--plan",
+        help="write the files a sync would download to PLAN as JSON lines,"
+        + " without downloading",
+        default=None,
+    )
+    parser.add_argument(
+        "--apply",
+        help="download the files of a plan written by --plan, implies -y",
+        metavar="PLAN",
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        help="sync the courses in this many processes, implies -y;"
+        + " not used with --watch, --plan, --apply or --batch",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--verify",
+        help="check the checksums of synced files first and download corrupt ones again",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--http2",
+        help="multiplex canvas API requests over HTTP/2, needs the http2 extra",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--api-timeout",
+        help="timeout of canvas API requests in seconds",
+        default=5,
+        type=float,
+    )
+    parser.add_argument(
+        "--download-timeout",
+        help="timeout of file downloads in seconds",
+        default=5,
+        type=float,
+    )
+    parser.add_argument(
+        "--keepalive",
+        help="seconds to keep idle connections open for reuse",
+        default=5,
+        type=float,
+    )
+    parser.add_argument(
+        "--progress",
+        help="progress display: one bar, a bar per course or per file, json "
+        "lines or nothing; auto shows a bar on a terminal and nothing otherwise",
+        default="auto",
+        choices=PROGRESS_MODES,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        help="read size of downloads in KB",
+        default=CHUNK_SIZE,
+        type=int,
+    )
+    parser.add_argument(
+        "--batch",
+        help="sync the accounts of several config files in one process, implies -y",
+        metavar="CONFIG",
+        nargs="+",
+        default=None,
+    )
+    return parser
+
+
+def getConfigs(argv=None):
+    args = argumentParser().parse_args(argv)
+    if args.batch:
+        return [loadConfig(configPath, args) for configPath in args.batch]
     configPath = args.path
     if args.r or not os.path.exists(configPath):
         if not os.path.exists(configPath):
@@ -515,13 +3044,51 @@ def getConfig():
             if args.debug:
                 print(traceback.format_exc())
             exit(1)
+    return [loadConfig(configPath, args)]
+
+
+def loadConfig(configPath, args):
     config = json.load(open(configPath, mode="r", encoding="utf-8"))
-    config["y"] = args.y
+    config["y"] = (
+        args.y
+        or bool(args.watch)
+        or bool(args.batch)
+        or bool(args.apply)
+        or args.workers > 1
+    )
     config["proxy"] = args.proxy
     config["no_subfolder"] = args.no_subfolder
     config["connection_count"] = args.connection
     config["no_keep_older_version"] = args.no_keep_older_version
     config["debug"] = args.debug
+    config["cache_dir"] = args.cache_dir
+    config["cache_size"] = args.cache_size
+    config["split_size"] = args.split_size
+    config["split_count"] = args.split_count
+    config["pipeline"] = args.pipeline
+    config["dedup"] = args.dedup
+    config["discover"] = args.discover
+    config["watch"] = args.watch
+    config["report"] = args.report
+    config["metrics"] = args.metrics
+    config["incremental"] = args.incremental
+    config["full_listing_interval"] = args.full_listing_interval
+    config["order"] = args.order
+    config["type_priority"] = dict(args.type_priority)
+    config["max_rate"] = args.max_rate
+    config["course_cache_ttl"] = args.course_cache_ttl
+    config["plan"] = args.plan
+    config["apply"] = args.apply
+    config["workers"] = args.workers
+    config["verify"] = args.verify
+    config["http2"] = args.http2
+    config["api_timeout"] = args.api_timeout
+    config["download_timeout"] = args.download_timeout
+    config["keepalive"] = args.keepalive
+    config["progress"] = args.progress
+    config["chunk_size"] = args.chunk_size
+    if args.watch or args.plan or args.apply or args.batch:
+        config["workers"] = 1
     if not "allowAudio" in config:
         config["allowAudio"] = True
     if not "allowVideo" in config:
@@ -532,43 +3099,129 @@ def getConfig():
     return config
 
 
-async def sync():
-    syncer = None
+async def syncOne(syncer):
     try:
-        config = getConfig()
-        while True:
-            try:
-                syncer = CanvasSyncer(config)
-                await syncer.sync()
-                break
-            except httpx.ConnectError as e:
-                if config["connection_count"] == 2:
-                    raise e
-                config["connection_count"] //= 2
-                print(
-                    "Server connect error, reducing connection count "
-                    f"to {config['connection_count']} and retrying..."
+        if syncer.config["verify"]:
+            await syncer.verify()
+        if syncer.config["plan"]:
+            await syncer.plan(syncer.config["plan"])
+        elif syncer.config["apply"]:
+            await syncer.apply(syncer.config["apply"])
+        elif syncer.config["watch"]:
+            await syncer.watch(syncer.config["watch"])
+        else:
+            await syncer.sync()
+            syncer.finishRun()
+    except Exception as e:
+        printUnexpectedError(e, syncer.config["debug"])
+
+
+def syncShard(config, courseCode, progressQueue):
+    """Syncs the courses in courseCode in a --workers process."""
+
+    async def syncCourses():
+        syncer = CanvasSyncer(config)
+        syncer.courseCode = courseCode
+        syncer.client.progressQueue = progressQueue
+        try:
+            await syncer.sync()
+            syncer.finishRun()
+        except Exception as e:
+            printUnexpectedError(e, config["debug"])
+        finally:
+            await syncer.aclose()
+        return syncer.client.failures, syncer.client.metrics
+
+    if platform.system() == "Windows":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    return asyncio.run(syncCourses())
+
+
+async def syncSharded(syncer, workerCount):
+    # courses are spread over processes, which split the connection budget
+    config = syncer.config
+    if config["verify"]:
+        await syncer.verify()
+    await syncer.prepareCourses()
+    courses = list(syncer.courseCode.items())
+    shards = [dict(courses[i::workerCount]) for i in range(workerCount)]
+    shards = [shard for shard in shards if shard]
+    shardConfig = {
+        **config,
+        "connection_count": max(1, config["connection_count"] // len(shards)),
+        "max_rate": config["max_rate"] / len(shards),
+        "shard": True,
+    }
+    loop = asyncio.get_running_loop()
+    with multiprocessing.Manager() as manager:
+        progressQueue = manager.Queue()
+        progress = threading.Thread(
+            target=showProgress,
+            args=(progressQueue, progressMode(config["progress"])),
+        )
+        progress.start()
+        try:
+            with concurrent.futures.ProcessPoolExecutor(len(shards)) as executor:
+                results = await asyncio.gather(
+                    *[
+                        loop.run_in_executor(
+                            executor, syncShard, shardConfig, shard, progressQueue
+                        )
+                        for shard in shards
+                    ]
                 )
+        finally:
+            progressQueue.put((None, None))
+            progress.join()
+    failures = []
+    for shardFailures, metrics in results:
+        failures += shardFailures
+        syncer.client.metrics.merge(metrics)
+    printFailures(failures)
+    # compact what the processes appended to the index
+    SyncIndex(syncer.downloadDir)
+
+
+async def sync(configs):
+    syncers = []
+    pool = None
+    config = configs[0]
+    try:
+        if len(configs) > 1:
+            # accounts share connections, the connection budget and downloads
+            pool = SharedPool(
+                config["connection_count"], config["proxy"], **poolOptions(config)
+            )
+        syncers = [CanvasSyncer(config, pool) for config in configs]
+        if len(configs) == 1 and config["workers"] > 1:
+            await syncSharded(syncers[0], config["workers"])
+        else:
+            await asyncio.gather(*[syncOne(syncer) for syncer in syncers])
+        # accounts of a batch share the metrics of their pool
+        syncers[0].writeMetrics()
     except KeyboardInterrupt as e:
         raise e
     except Exception as e:
-        errorName = e.__class__.__name__
-        print(
-            f"Unexpected error: {errorName}. Please check your network and token!"
-            + ("" if config["debug"] else " Or use -d for detailed information.")
-        )
-        if config["debug"]:
-            print(traceback.format_exc())
+        printUnexpectedError(e, config["debug"])
     finally:
-        if syncer:
+        for syncer in syncers:
             await syncer.aclose()
+        if pool:
+            await pool.aclose()
 
 
 def run():
+    # the processes of --workers and --verify start the frozen exe again
+    multiprocessing.freeze_support()
     try:
+        # -V and -h exit here, before httpx is imported
+        try:
+            configs = getConfigs()
+        except Exception as e:
+            return printUnexpectedError(e, False)
         if platform.system() == "Windows":
             asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-        asyncio.run(sync())
+        asyncio.run(sync(configs))
     except KeyboardInterrupt:
         print("\nOperation cancelled by user, exiting...")
         exit(1)
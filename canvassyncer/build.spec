@@ -9,7 +9,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    hiddenimports=['httpx', 'tqdm'],
     hookspath=[],
     runtime_hooks=[],
     excludes=[],
@@ -43,7 +43,7 @@ setup(
     author_email="bomingzh@sjtu.edu.cn",
     maintainer="BoYanZh",
     maintainer_email="bomingzh@sjtu.edu.cn",
-    packages=find_packages(),
+    packages=find_packages(exclude=["tests"]),
     python_requires=">=3.6",
     entry_points={
         "console_scripts": [
@@ -54,5 +54,6 @@ setup(
         "Bug Reports": "https://github.com/BoYanZh/Canvas-Syncer/issues",
         "Source": "https://github.com/BoYanZh/Canvas-Syncer",
     },
-    install_requires=["httpx", "aiofiles", "tqdm"],
+    install_requires=["httpx", "tqdm"],
+    extras_require={"http2": ["httpx[http2]"]},
 )
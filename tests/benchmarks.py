@@ -0,0 +1,409 @@
+"""Benchmarks of canvassyncer against the mock canvas server, which need no
+network access:
+
+    python -m tests.benchmarks [--quick] [--dir DIR] [--output FILE] [NAME ...]
+
+Every benchmark prints a JSON line per measured case. --quick shrinks the
+courses so that the whole suite runs in CI within a few minutes. --dir puts
+the download directories on another filesystem, e.g. a network share.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from canvassyncer.__main__ import CanvasSyncer, FileRecord, readJsonRecords
+from tests.mockcanvas import MockCanvas, localPath, makeConfig, writeConfig
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def requestCount(canvas):
+    return sum(canvas.requests.values())
+
+
+def childCpuTime():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def runCli(canvas, downloadDir, *argv, courseIDs=None, stderr=None):
+    """Syncs downloadDir in a canvassyncer process of its own, so that its
+    peak RSS and CPU time are its own, and returns its run report."""
+    configPath = writeConfig(canvas, downloadDir, courseIDs)
+    reportPath = os.path.join(os.path.dirname(downloadDir), "report.json")
+    requests = requestCount(canvas)
+    cpuTime = childCpuTime()
+    start = time.monotonic()
+    subprocess.run(
+        [sys.executable, "-m", "canvassyncer", "-p", configPath, "-y"]
+        + ["--report", reportPath, *argv],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=stderr,
+    )
+    wallTime = time.monotonic() - start
+    if cpuTime is not None:
+        cpuTime = round(childCpuTime() - cpuTime, 3)
+    with open(reportPath) as f:
+        report = json.load(f)
+    return {
+        "requests": requestCount(canvas) - requests,
+        "wallTime": round(wallTime, 3),
+        "cpuTime": cpuTime,
+        "peakRss": report["peakRss"],
+        "downloadedBytes": report["downloadedBytes"],
+        "downloadedFiles": sum(c["files"] for c in report["courses"].values()),
+        "retries": sum(report["retries"].values()),
+        "bytesPerSecond": round(report["bytesPerSecond"]),
+    }
+
+
+@benchmark
+def sync(quick):
+    """Cold, warm and no-op syncs of a mirror. The warm sync finds a tenth
+    of the files updated and revalidates the listing cache."""
+    courses = {courseID: 200 if quick else 2000 for courseID in range(1, 4)}
+    with MockCanvas(courses=courses) as canvas, tempfile.TemporaryDirectory() as tmp:
+        downloadDir = os.path.join(tmp, "dl")
+        cacheDir = ["--cache-dir", os.path.join(tmp, "cache")]
+        fileCount = sum(courses.values())
+        yield {
+            "case": "cold",
+            "files": fileCount,
+            **runCli(canvas, downloadDir, *cacheDir),
+        }
+        for files in canvas.files.values():
+            for f in files[::10]:
+                canvas.touch(f["id"])
+        yield {
+            "case": "warm",
+            "files": fileCount,
+            **runCli(canvas, downloadDir, *cacheDir),
+        }
+        yield {
+            "case": "noop",
+            "files": fileCount,
+            **runCli(canvas, downloadDir, *cacheDir),
+        }
+
+
+@benchmark
+def pagination(quick):
+    """Requests per course to plan the sync of courses of 10, 1k and 10k
+    files, with and without a rel="last" link to fan the pages out from."""
+    for fileCount in (10, 1000, 10000):
+        for exposeLast in (True, False):
+            with MockCanvas(
+                courses={1: fileCount}, exposeLast=exposeLast
+            ) as canvas, tempfile.TemporaryDirectory() as tmp:
+                downloadDir = os.path.join(tmp, "dl")
+                result = runCli(canvas, downloadDir, "--plan", downloadDir + ".plan")
+                yield {
+                    "files": fileCount,
+                    "last": exposeLast,
+                    "courseRequests": canvas.courseRequests[1],
+                    "filesRequests": canvas.requests["courses/N/files"],
+                    **result,
+                }
+
+
+async def timeDiff(config, courseID):
+    """Wall time of the diff of the local files of a course against its
+    listing, which is fetched beforehand."""
+    syncer = CanvasSyncer(config)
+    try:
+        await syncer.prepareCourses()
+        listing = await syncer.getCourseFiles(courseID)
+
+        async def getCourseFiles(courseID):
+            return listing
+
+        syncer.getCourseFiles = getCourseFiles
+        start = time.monotonic()
+        await syncer.getCourseTaskInfo(courseID)
+        return round(time.monotonic() - start, 3), len(syncer.newFiles)
+    finally:
+        await syncer.aclose()
+
+
+@benchmark
+def diff(quick):
+    """The diff phase of a course of 50k files: with no local files, with
+    local files missing from the index and with indexed local files."""
+    fileCount = 5000 if quick else 50000
+    with MockCanvas(
+        courses={1: fileCount}, fileSize=lambda i: 100
+    ) as canvas, tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(
+        io.StringIO()
+    ):
+        downloadDir = os.path.join(tmp, "dl")
+        config = makeConfig(canvas, downloadDir)
+        results = [("new", asyncio.run(timeDiff(config, 1)))]
+        for f in canvas.files[1]:
+            with open(localPath(downloadDir, canvas, f), "wb") as local:
+                local.write(b"x" * f["size"])
+        # the first diff indexes the local files, the second finds them indexed
+        results.append(("unindexed", asyncio.run(timeDiff(config, 1))))
+        results.append(("indexed", asyncio.run(timeDiff(config, 1))))
+    for case, (wallTime, newFiles) in results:
+        yield {
+            "case": case,
+            "files": fileCount,
+            "newFiles": newFiles,
+            "wallTime": wallTime,
+        }
+
+
+class StreamedBody:
+    """Stands in for the response whose body readJsonRecords decodes."""
+
+    def __init__(self, body, chunkSize=65536):
+        self.body = body
+        self.chunkSize = chunkSize
+
+    async def aiter_text(self):
+        for start in range(0, len(self.body), self.chunkSize):
+            yield self.body[start : start + self.chunkSize].decode()
+
+
+def tracedMemory(func):
+    """Peak and retained bytes allocated by func, and its result."""
+    tracemalloc.start()
+    try:
+        res = func()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return res, {"peakBytes": peak, "retainedBytes": retained}
+
+
+@benchmark
+def listingMemory(quick):
+    """Memory to parse a listing of many files, decoded at once by json into
+    dicts or streamed into FileRecords, and the peak RSS to plan the sync of
+    many courses listed concurrently."""
+    fileCount = 10000 if quick else 100000
+    with MockCanvas(courses={1: fileCount}, fileSize=lambda i: 100) as canvas:
+        body = json.dumps([canvas.apiFile(f) for f in canvas.files[1]]).encode()
+    _, memory = tracedMemory(lambda: json.loads(body.decode()))
+    yield {"case": "json", "files": fileCount, "bodyBytes": len(body), **memory}
+    _, memory = tracedMemory(
+        lambda: asyncio.run(readJsonRecords(StreamedBody(body), FileRecord))
+    )
+    yield {"case": "streaming", "files": fileCount, "bodyBytes": len(body), **memory}
+    courses = {courseID: 500 if quick else 5000 for courseID in range(1, 21)}
+    with MockCanvas(courses=courses) as canvas, tempfile.TemporaryDirectory() as tmp:
+        downloadDir = os.path.join(tmp, "dl")
+        yield {
+            "case": "plan",
+            "files": sum(courses.values()),
+            **runCli(canvas, downloadDir, "--plan", downloadDir + ".plan"),
+        }
+
+
+@benchmark
+def throttling(quick):
+    """Syncs from a server that answers 429 with Retry-After above 8
+    concurrent requests, with several connection counts. Every file should
+    arrive, the adaptive limiter keeps the throughput up."""
+    fileCount = 200 if quick else 2000
+    for connections in (4, 16, 64):
+        with MockCanvas(
+            courses={1: fileCount},
+            fileSize=lambda i: 20000 + i,
+            latency=0.02,
+            maxConcurrent=8,
+            retryAfter="0.2",
+        ) as canvas, tempfile.TemporaryDirectory() as tmp:
+            result = runCli(canvas, os.path.join(tmp, "dl"), "-c", str(connections))
+            yield {
+                "connections": connections,
+                "files": fileCount,
+                "throttled": canvas.statuses[429],
+                **result,
+            }
+
+
+@benchmark
+def connections(quick):
+    """Requests per second and connections opened for a cold sync of many
+    small files with -c 16, reusing idle connections or not, and over HTTP/2
+    when h2 is installed. The mock serves HTTP/1.1 only, so HTTP/2 shows its
+    fallback there and its multiplexing only against a real canvas."""
+    fileCount = 500 if quick else 5000
+    variants = {"keepalive": [], "no keepalive": ["--keepalive", "0"]}
+    if importlib.util.find_spec("h2") is not None:
+        variants["http2"] = ["--http2"]
+    for variant, argv in variants.items():
+        with MockCanvas(
+            courses={1: fileCount}, fileSize=lambda i: 1000, latency=0.01
+        ) as canvas, tempfile.TemporaryDirectory() as tmp:
+            result = runCli(canvas, os.path.join(tmp, "dl"), "-c", "16", *argv)
+            yield {
+                "variant": variant,
+                "files": fileCount,
+                "connectionsOpened": canvas.connections,
+                "requestsPerSecond": round(result["requests"] / result["wallTime"]),
+                **result,
+            }
+
+
+@benchmark
+def workers(quick):
+    """Cold syncs of many courses with 1, 2 and 4 --workers processes.
+
+    The mock server shares the GIL of the benchmark process, so the scaling
+    shows best on machines with more cores than workers. The peak RSS is the
+    one of the parent process.
+    """
+    courses = {courseID: 100 if quick else 2000 for courseID in range(1, 9)}
+    for workerCount in (1, 2, 4):
+        with MockCanvas(
+            courses=courses
+        ) as canvas, tempfile.TemporaryDirectory() as tmp:
+            result = runCli(
+                canvas, os.path.join(tmp, "dl"), "--workers", str(workerCount)
+            )
+            yield {
+                "workers": workerCount,
+                "cpus": os.cpu_count(),
+                "files": sum(courses.values()),
+                **result,
+            }
+
+
+@benchmark
+def filesystem(quick):
+    """Syncs of many small files, where the filesystem rather than the network
+    sets the pace: a cold sync, one that links duplicates and a no-op sync
+    that revalidates the listing cache."""
+    fileCount = 1000 if quick else 10000
+    with MockCanvas(
+        courses={1: fileCount}, fileSize=lambda i: 1000 + i % 1000
+    ) as canvas, tempfile.TemporaryDirectory() as tmp:
+        downloadDir = os.path.join(tmp, "dl")
+        cacheDir = ["--cache-dir", os.path.join(tmp, "cache")]
+        yield {
+            "case": "cold",
+            "files": fileCount,
+            **runCli(canvas, downloadDir, *cacheDir),
+        }
+        # a second course shares the content of the first one
+        canvas.addCourse(2, fileCount, fileSize=lambda i: 1000 + i % 1000)
+        for f, duplicate in zip(canvas.files[1], canvas.files[2]):
+            canvas.duplicate(duplicate["id"], f["id"])
+        yield {
+            "case": "dedup",
+            "files": fileCount,
+            **runCli(canvas, downloadDir, "--dedup", *cacheDir, courseIDs=[1, 2]),
+        }
+        yield {
+            "case": "noop",
+            "files": 2 * fileCount,
+            **runCli(canvas, downloadDir, *cacheDir, courseIDs=[1, 2]),
+        }
+
+
+@benchmark
+def progress(quick):
+    """CPU seconds per GB downloaded with each progress display and with
+    several read sizes. The mock sends no md5, so only the local digest of
+    the downloads is computed."""
+    fileCount, fileSize = (4, 32000000) if quick else (8, 128000000)
+    cases = [(mode, "256") for mode in ("bar", "file", "json", "quiet")]
+    cases += [("quiet", chunkSize) for chunkSize in ("16", "1024", "4096")]
+    for mode, chunkSize in cases:
+        with MockCanvas(
+            courses={1: fileCount}, fileSize=lambda i: fileSize, md5=False
+        ) as canvas, tempfile.TemporaryDirectory() as tmp:
+            result = runCli(
+                canvas,
+                os.path.join(tmp, "dl"),
+                *["--progress", mode, "--chunk-size", chunkSize],
+                stderr=subprocess.DEVNULL,
+            )
+            gigabytes = result["downloadedBytes"] / 1e9
+            yield {
+                "progress": mode,
+                "chunkSize": int(chunkSize),
+                "cpuPerGB": result["cpuTime"]
+                and round(result["cpuTime"] / gigabytes, 3),
+                **result,
+            }
+
+
+def bestTime(argv, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        subprocess.run(argv, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.monotonic() - start)
+    return round(min(times), 4)
+
+
+@benchmark
+def startup(quick):
+    """Wall time of quick command lines, against a bare interpreter, and the
+    import time of canvassyncer and the modules it imports."""
+    repeat = 5 if quick else 20
+    python = [sys.executable, "-m", "canvassyncer"]
+    yield {"case": "python", "wallTime": bestTime([sys.executable, "-c", ""], repeat)}
+    for argv in (["-V"], ["-h"]):
+        yield {"case": " ".join(argv), "wallTime": bestTime(python + argv, repeat)}
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import canvassyncer.__main__"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    for line in res.stderr.splitlines():
+        if line.endswith("| canvassyncer.__main__"):
+            micros = int(line.split("|")[1])
+            yield {"case": "import", "importTime": micros / 1000000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("names", nargs="*", metavar="NAME", help=", ".join(BENCHMARKS))
+    parser.add_argument("--quick", help="benchmark small courses", action="store_true")
+    parser.add_argument("--dir", help="create the download directories in DIR")
+    parser.add_argument("--output", help="also append the results to this file")
+    args = parser.parse_args()
+    if args.dir:
+        tempfile.tempdir = args.dir
+    unknown = set(args.names) - BENCHMARKS.keys()
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    for name in args.names or BENCHMARKS:
+        for result in BENCHMARKS[name](args.quick):
+            line = json.dumps({"benchmark": name, **result})
+            print(line, flush=True)
+            if args.output:
+                with open(args.output, "a") as f:
+                    print(line, file=f)
+
+
+if __name__ == "__main__":
+    main()
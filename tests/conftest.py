@@ -0,0 +1,28 @@
+import pytest
+
+from tests.mockcanvas import MockCanvas
+
+
+@pytest.fixture
+def mockCanvas():
+    """Starts mock canvas servers with the given options, stopped after the
+    test."""
+    servers = []
+
+    def start(**options):
+        servers.append(MockCanvas(**options).start())
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def canvas(mockCanvas):
+    return mockCanvas(courses={1: 12, 2: 5})
+
+
+@pytest.fixture
+def downloadDir(tmp_path):
+    return tmp_path / "dl"
@@ -0,0 +1,483 @@
+"""A local mock of the parts of the Canvas API that canvassyncer uses, so the
+tests and benchmarks run without network access.
+
+The server pages listings with Link headers, serves file blobs with Range
+support, and can add latency, cap the bandwidth and inject 429 and 5xx
+responses. It counts the requests it answers and the connections it accepts.
+"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from canvassyncer.__main__ import CanvasSyncer, argumentParser, loadConfig, syncOne
+
+TIMESTAMP = "2024-01-01T00:00:00Z"
+SEND_CHUNK = 64 * 1024
+
+
+def defaultFileSize(i):
+    return 1000 + i * 37 % 4000
+
+
+class MockCanvas:
+    """Serves courses of generated files on 127.0.0.1.
+
+    courses maps course ids to their number of files. Every course has
+    folderCount folders, the files are spread over them in turn.
+
+    throttle and errorRate are the chances of a 429 or 503 response,
+    maxConcurrent answers 429 to requests above that many at once and
+    failFirst fails the first attempts at every path with a 503, or only at
+    the paths of the request kinds in failKinds.
+    bandwidth caps each response in bytes per second.
+    """
+
+    def __init__(
+        self,
+        courses=None,
+        folderCount=2,
+        fileSize=defaultFileSize,
+        latency=0,
+        bandwidth=0,
+        throttle=0,
+        errorRate=0,
+        maxConcurrent=0,
+        failFirst=0,
+        failKinds=None,
+        retryAfter="0.1",
+        md5=True,
+        exposeLast=True,
+        seed=0,
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle = throttle
+        self.errorRate = errorRate
+        self.maxConcurrent = maxConcurrent
+        self.failFirst = failFirst
+        self.failKinds = failKinds
+        self.retryAfter = retryAfter
+        self.md5 = md5
+        self.exposeLast = exposeLast
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.attempts = collections.Counter()
+        self.requests = collections.Counter()
+        self.courseRequests = collections.Counter()
+        self.statuses = collections.Counter()
+        self.log = []
+        self.connections = 0
+        self.courses = {}
+        self.folders = {}
+        self.files = {}
+        self.hidden = {}
+        self.byID = {}
+        self.contentOf = {}
+        self.digests = {}
+        self.hiddenFilesTab = set()
+        self.extras = collections.defaultdict(dict)
+        self.server = None
+        for courseID, fileCount in (courses or {1: 10}).items():
+            self.addCourse(courseID, fileCount, folderCount, fileSize)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def addCourse(self, courseID, fileCount, folderCount=2, fileSize=defaultFileSize):
+        self.courses[courseID] = {
+            "id": courseID,
+            "course_code": f"TEST{courseID}",
+            "name": f"Test course {courseID}",
+            "workflow_state": "available",
+            "term": {"name": "Default Term"},
+        }
+        self.folders[courseID] = [
+            {
+                "id": courseID * 1000 + j,
+                "full_name": f"course files/folder{j}" if j else "course files",
+            }
+            for j in range(folderCount)
+        ]
+        files = self.files[courseID] = [
+            self.fileObject(
+                courseID * 1000000 + i,
+                self.folders[courseID][i % folderCount]["id"],
+                f"v{i}.mp4" if i % 5 == 0 else f"f{i}.pdf",
+                fileSize(i),
+            )
+            for i in range(fileCount)
+        ]
+        self.byID.update((f["id"], f) for f in files)
+
+    def fileObject(self, fileID, folderID, name, size):
+        return {
+            "id": fileID,
+            "folder_id": folderID,
+            "display_name": name,
+            "filename": name,
+            "size": size,
+            "modified_at": TIMESTAMP,
+            "updated_at": TIMESTAMP,
+            "uuid": f"uuid{fileID}",
+            "content-type": "application/octet-stream",
+        }
+
+    def addHiddenFile(self, courseID, fileID, folderID, name, size=2000):
+        # resolvable by id, but not in the files listing of the course
+        self.hidden[fileID] = self.fileObject(fileID, folderID, name, size)
+        self.byID[fileID] = self.hidden[fileID]
+
+    def file(self, fileID):
+        return self.byID.get(fileID)
+
+    def listedFile(self, courseID, index):
+        return self.files[courseID][index]
+
+    def touch(self, fileID, timestamp="2025-01-01T00:00:00Z"):
+        f = self.file(fileID)
+        f["modified_at"] = f["updated_at"] = timestamp
+        self.digests.pop(fileID, None)
+
+    def rename(self, fileID, name, folderID=None):
+        f = self.file(fileID)
+        f["display_name"] = f["filename"] = name
+        if folderID is not None:
+            f["folder_id"] = folderID
+
+    def duplicate(self, fileID, ofFileID):
+        # serve the content of ofFileID for fileID
+        self.contentOf[fileID] = ofFileID
+        self.file(fileID)["size"] = self.file(ofFileID)["size"]
+        self.digests.pop(fileID, None)
+
+    def content(self, fileID, start=0, end=None):
+        """The bytes start to end of a file, generated from a pattern that
+        also depends on its modification time."""
+        f = self.file(fileID)
+        end = f["size"] if end is None else min(end, f["size"])
+        source = self.file(self.contentOf.get(fileID, fileID))
+        pattern = f"{source['id']}-{source['modified_at']};".encode()
+        offset = start % len(pattern)
+        repeated = pattern * ((end - start + offset) // len(pattern) + 1)
+        return repeated[offset : offset + end - start]
+
+    def chunks(self, fileID, start=0, end=None):
+        """The content of a file in pieces, so that large files are never
+        held in memory at once."""
+        end = self.file(fileID)["size"] if end is None else end
+        for chunkStart in range(start, end, SEND_CHUNK):
+            yield self.content(fileID, chunkStart, min(chunkStart + SEND_CHUNK, end))
+
+    def digest(self, fileID):
+        if fileID not in self.digests:
+            md5 = hashlib.md5()
+            for chunk in self.chunks(fileID):
+                md5.update(chunk)
+            self.digests[fileID] = md5.hexdigest()
+        return self.digests[fileID]
+
+    def apiFile(self, f):
+        res = {**f, "url": f"{self.url}/files/{f['id']}/download?verifier=v"}
+        if self.md5:
+            res["md5"] = self.digest(f["id"])
+        return res
+
+    def downloads(self):
+        return self.requests["download"]
+
+    def start(self):
+        handler = type("Handler", (MockHandler,), {"canvas": self})
+        self.server = MockServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    canvas = None
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.canvas.lock:
+            self.canvas.connections += 1
+
+    def send(self, status, body=b"", headers=(), length=None):
+        """Answers with body, bytes, a JSON value or length bytes in chunks."""
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            headers = [("Content-Type", "application/json"), *headers]
+        if isinstance(body, bytes):
+            length = len(body)
+            body = [
+                body[start : start + SEND_CHUNK]
+                for start in range(0, length, SEND_CHUNK)
+            ]
+        self.send_response(status)
+        for key, val in headers:
+            self.send_header(key, val)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.write(body)
+        with self.canvas.lock:
+            self.canvas.statuses[status] += 1
+        return status
+
+    def write(self, chunks):
+        for chunk in chunks:
+            self.wfile.write(chunk)
+            if self.canvas.bandwidth:
+                time.sleep(len(chunk) / self.canvas.bandwidth)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        canvas = self.canvas
+        url = urlsplit(self.path)
+        kind = self.kind(url.path)
+        with canvas.lock:
+            canvas.inflight += 1
+            inflight = canvas.inflight
+            canvas.requests[kind] += 1
+            canvas.attempts[url.path] += 1
+            attempt = canvas.attempts[url.path]
+            courseID = re.match(r"/api/v1/courses/(\d+)", url.path)
+            if courseID:
+                canvas.courseRequests[int(courseID[1])] += 1
+        try:
+            if canvas.latency:
+                time.sleep(canvas.latency)
+            if canvas.maxConcurrent and inflight > canvas.maxConcurrent:
+                status = self.throttled()
+            elif canvas.random.random() < canvas.throttle:
+                status = self.throttled()
+            elif (
+                attempt <= canvas.failFirst
+                and (canvas.failKinds is None or kind in canvas.failKinds)
+            ) or (canvas.random.random() < canvas.errorRate):
+                status = self.send(503, {"errors": [{"message": "unavailable"}]})
+            else:
+                status = self.route(url)
+        finally:
+            with canvas.lock:
+                canvas.inflight -= 1
+        canvas.log.append((self.command, self.path, self.headers.get("Range"), status))
+
+    def throttled(self):
+        return self.send(
+            429,
+            b"403 Forbidden (Rate Limit Exceeded)",
+            [("Retry-After", self.canvas.retryAfter), ("X-Rate-Limit-Remaining", "0")],
+        )
+
+    @staticmethod
+    def kind(path):
+        if path.endswith("/download"):
+            return "download"
+        path = re.sub(r"/\d+", "/N", path)
+        return path[len("/api/v1/") :] if path.startswith("/api/v1/") else path
+
+    def route(self, url):
+        canvas = self.canvas
+        query = {key: val[0] for key, val in parse_qs(url.query).items()}
+        path = url.path
+        m = re.fullmatch(r"/files/(\d+)/download", path)
+        if m:
+            return self.download(int(m[1]))
+        if path == "/api/v1/courses":
+            return self.page(list(canvas.courses.values()), url, query)
+        m = re.fullmatch(r"/api/v1/courses/(\d+)", path)
+        if m:
+            course = canvas.courses.get(int(m[1]))
+            return self.send(200, course) if course else self.notFound()
+        m = re.fullmatch(r"/api/v1/courses/(\d+)/folders", path)
+        if m:
+            return self.page(canvas.folders.get(int(m[1]), []), url, query)
+        m = re.fullmatch(r"/api/v1/folders/(\d+)", path)
+        if m:
+            for folders in canvas.folders.values():
+                for folder in folders:
+                    if folder["id"] == int(m[1]):
+                        return self.send(200, folder)
+            return self.notFound()
+        m = re.fullmatch(r"/api/v1/courses/(\d+)/files", path)
+        if m:
+            courseID = int(m[1])
+            if courseID in canvas.hiddenFilesTab:
+                return self.send(
+                    401, {"errors": [{"message": "user authorization required"}]}
+                )
+            files = canvas.files.get(courseID, [])
+            if query.get("sort") == "updated_at":
+                files = sorted(
+                    files,
+                    key=lambda f: f["updated_at"],
+                    reverse=query.get("order") == "desc",
+                )
+            return self.page([canvas.apiFile(f) for f in files], url, query)
+        m = re.fullmatch(r"/api/v1/(?:courses/\d+/)?files/(\d+)", path)
+        if m:
+            f = canvas.file(int(m[1]))
+            return self.send(200, canvas.apiFile(f)) if f else self.notFound()
+        m = re.fullmatch(r"/api/v1/courses/(\d+)/modules/(\d+)/items", path)
+        if m:
+            items = canvas.extras[int(m[1])].get("items", {}).get(int(m[2]), [])
+            return self.page(items, url, query)
+        m = re.fullmatch(
+            r"/api/v1/courses/(\d+)/(modules|assignments|pages|discussion_topics)",
+            path,
+        )
+        if m:
+            return self.page(canvas.extras[int(m[1])].get(m[2], []), url, query)
+        return self.notFound()
+
+    def notFound(self):
+        return self.send(
+            404, {"errors": [{"message": "The specified resource does not exist."}]}
+        )
+
+    def page(self, items, url, query):
+        perPage = min(int(query.get("per_page", 10)), 100)
+        page = int(query.get("page", 1))
+        last = max(1, -(-len(items) // perPage))
+        base = f"{self.canvas.url}{url.path}"
+
+        def link(number, rel):
+            params = urlencode({**query, "page": number, "per_page": perPage})
+            return f'<{base}?{params}>; rel="{rel}"'
+
+        links = [link(page, "current"), link(1, "first")]
+        if self.canvas.exposeLast:
+            links.append(link(last, "last"))
+        if page < last:
+            links.append(link(page + 1, "next"))
+        body = json.dumps(items[(page - 1) * perPage : page * perPage]).encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self.send(304, b"", [("ETag", etag)])
+        return self.send(
+            200,
+            body,
+            [
+                ("Content-Type", "application/json"),
+                ("Link", ",".join(links)),
+                ("ETag", etag),
+                ("X-Rate-Limit-Remaining", "700.0"),
+            ],
+        )
+
+    def download(self, fileID):
+        canvas = self.canvas
+        f = canvas.file(fileID)
+        if f is None:
+            return self.notFound()
+        size = f["size"]
+        etag = f'"{fileID}-{f["modified_at"]}"'
+        headers = [("ETag", etag), ("Accept-Ranges", "bytes")]
+        rangeHeader = self.headers.get("Range")
+        ifRange = self.headers.get("If-Range")
+        if rangeHeader and (ifRange is None or ifRange == etag):
+            start, _, end = rangeHeader[len("bytes=") :].partition("-")
+            start = int(start)
+            end = int(end) + 1 if end else size
+            if start >= size:
+                return self.send(
+                    416, b"", [*headers, ("Content-Range", f"bytes */{size}")]
+                )
+            end = min(end, size)
+            return self.send(
+                206,
+                canvas.chunks(fileID, start, end),
+                [*headers, ("Content-Range", f"bytes {start}-{end - 1}/{size}")],
+                end - start,
+            )
+        return self.send(200, canvas.chunks(fileID), headers, size)
+
+
+def writeConfig(canvas, downloadDir, courseIDs=None, **entries):
+    """Writes a config file next to downloadDir that syncs the courses of the
+    mock to it and returns its path."""
+    configPath = os.path.join(os.path.dirname(downloadDir), "canvassyncer.json")
+    config = {
+        "canvasURL": canvas.url,
+        "token": "token",
+        "courseCodes": [],
+        "courseIDs": list(canvas.courses) if courseIDs is None else courseIDs,
+        "downloadDir": str(downloadDir),
+        "filesizeThresh": 250,
+        "allowAudio": True,
+        "allowVideo": True,
+        "allowImage": True,
+        **entries,
+    }
+    with open(configPath, "w") as f:
+        json.dump(config, f)
+    return configPath
+
+
+def makeConfig(canvas, downloadDir, *argv, courseIDs=None, **entries):
+    """The config of a sync of the mock to downloadDir with the command line
+    arguments argv."""
+    configPath = writeConfig(canvas, downloadDir, courseIDs, **entries)
+    args = argumentParser().parse_args(["-p", configPath, "-y", *argv])
+    return loadConfig(configPath, args)
+
+
+async def runSyncer(config):
+    syncer = CanvasSyncer(config)
+    try:
+        await syncOne(syncer)
+    finally:
+        await syncer.aclose()
+    return syncer
+
+
+def runSync(config):
+    """Runs a sync like the command line does and returns its CanvasSyncer."""
+    return asyncio.run(runSyncer(config))
+
+
+def localPath(downloadDir, canvas, f):
+    """Where a sync puts the file f of the mock."""
+    courseID = f["id"] // 1000000
+    folder = next(d for d in canvas.folders[courseID] if d["id"] == f["folder_id"])
+    folderName = folder["full_name"][len("course files") :]
+    return os.path.join(downloadDir, f"TEST{courseID}{folderName}", f["display_name"])
+
+
+def assertSynced(downloadDir, canvas):
+    """Checks the content of every listed file of the mock in downloadDir."""
+    for files in canvas.files.values():
+        for f in files:
+            with open(localPath(downloadDir, canvas, f), "rb") as local:
+                assert local.read() == canvas.content(f["id"])
@@ -0,0 +1,22 @@
+import canvassyncer.__main__ as main
+from tests.mockcanvas import assertSynced, makeConfig, runSync
+
+
+def testDedupIgnoresOtherChecksums(canvas, downloadDir, monkeypatch):
+    first, second = canvas.listedFile(1, 1), canvas.listedFile(2, 1)
+    canvas.file(second["id"])["size"] = first["size"]
+    # files of the same size whose md5 field holds another kind of checksum
+    canvas.digests[first["id"]] = canvas.digests[second["id"]] = "sha256:" + "0" * 64
+    waiting = []
+    downloadDedupLeftovers = main.CanvasSyncer.downloadDedupLeftovers
+
+    async def recordWaiting(self):
+        waiting.extend(info for infos in self.dedupWaiting.values() for info in infos)
+        await downloadDedupLeftovers(self)
+
+    monkeypatch.setattr(main.CanvasSyncer, "downloadDedupLeftovers", recordWaiting)
+    syncer = runSync(makeConfig(canvas, downloadDir, "--dedup"))
+    assertSynced(downloadDir, canvas)
+    assert syncer.linkedCount == 0
+    # neither file waits for the other to be downloaded
+    assert waiting == []
@@ -0,0 +1,42 @@
+import os
+from urllib.parse import urlsplit
+
+from tests.mockcanvas import makeConfig, runSync
+
+
+def fileLink(fileID):
+    return f'<a href="/courses/1/files/{fileID}/download">slides</a>'
+
+
+def testDiscoverHiddenFiles(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 0})
+    canvas.hiddenFilesTab.add(1)
+    canvas.addHiddenFile(1, 5001, 1001, "lecture.pdf")
+    # the folder of this one cannot be looked up
+    canvas.addHiddenFile(1, 5002, 9999, "orphan.pdf")
+    itemsUrl = f"{canvas.url}/api/v1/courses/1/modules/2/items"
+    canvas.extras[1] = {
+        "modules": [
+            {"id": 1, "items": [{"type": "File", "content_id": 5001}]},
+            # canvas leaves out the items of large modules
+            {"id": 2, "items_url": itemsUrl},
+        ],
+        "items": {2: [{"type": "File", "content_id": 5002}]},
+        "assignments": [{"id": 1, "description": fileLink(5001)}],
+        "pages": [{"url": "intro", "body": fileLink(5001) + fileLink(5002)}],
+        "discussion_topics": [{"id": 1, "message": "", "attachments": [{"id": 5001}]}],
+    }
+    sources = ["modules", "assignments", "pages", "announcements"]
+    syncer = runSync(makeConfig(canvas, downloadDir, "--discover", *sources))
+    assert syncer.client.failures == []
+    paths = [urlsplit(path).path for _, path, *_ in canvas.log]
+    # every file is resolved and downloaded once, however often it is linked
+    assert paths.count("/api/v1/courses/1/files/5001") == 1
+    assert paths.count("/api/v1/courses/1/files/5002") == 1
+    assert canvas.downloads() == 2
+    for fileID, path in (
+        (5001, "TEST1/folder1/lecture.pdf"),
+        (5002, "TEST1/modules/orphan.pdf"),
+    ):
+        with open(os.path.join(downloadDir, path), "rb") as local:
+            assert local.read() == canvas.content(fileID)
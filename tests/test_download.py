@@ -0,0 +1,121 @@
+import json
+import os
+
+import canvassyncer.__main__ as main
+from canvassyncer.__main__ import writeValidator
+from tests.mockcanvas import assertSynced, localPath, makeConfig, runSync
+
+
+def leaveTempFile(canvas, downloadDir, f, content):
+    # what a run killed during or right after the download leaves behind
+    path = localPath(downloadDir, canvas, f)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".temp", "wb") as temp:
+        temp.write(content)
+    writeValidator(path + ".temp", f'"{f["id"]}-{f["modified_at"]}"')
+    return path
+
+
+def requestsOf(canvas, f):
+    return [entry for entry in canvas.log if f"/files/{f['id']}/" in entry[1]]
+
+
+def testResume(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 3})
+    f = canvas.listedFile(1, 1)
+    leaveTempFile(canvas, downloadDir, f, canvas.content(f["id"], 0, 500))
+    syncer = runSync(makeConfig(canvas, downloadDir))
+    assert syncer.client.failures == []
+    assertSynced(downloadDir, canvas)
+    assert [(r, status) for _, _, r, status in requestsOf(canvas, f)] == [
+        ("bytes=500-", 206)
+    ]
+
+
+def testResumeComplete(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 3})
+    f = canvas.listedFile(1, 1)
+    path = leaveTempFile(canvas, downloadDir, f, canvas.content(f["id"]))
+    syncer = runSync(makeConfig(canvas, downloadDir))
+    assert syncer.client.failures == []
+    assertSynced(downloadDir, canvas)
+    assert [status for *_, status in requestsOf(canvas, f)] == [416]
+    assert not os.path.exists(path + ".temp")
+    assert not os.path.exists(path + ".temp.etag")
+
+
+def testResumeCompleteCorrupt(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 3})
+    f = canvas.listedFile(1, 1)
+    leaveTempFile(canvas, downloadDir, f, b"x" * f["size"])
+    syncer = runSync(makeConfig(canvas, downloadDir))
+    assert syncer.client.failures == []
+    assertSynced(downloadDir, canvas)
+    assert [status for *_, status in requestsOf(canvas, f)] == [416, 200]
+
+
+def splitConfig(canvas, downloadDir):
+    return makeConfig(canvas, downloadDir, "--split-size", "0", "--split-count", "4")
+
+
+def testSplitRetriesOnlyFailedPart(mockCanvas, downloadDir, monkeypatch):
+    # save the progress of the parts as they go
+    monkeypatch.setattr(main, "SPLIT_CHECKPOINT_SIZE", 10000)
+    canvas = mockCanvas(
+        courses={1: 2}, fileSize=lambda i: 100000, failFirst=1, failKinds={"download"}
+    )
+    syncer = runSync(splitConfig(canvas, downloadDir))
+    assert syncer.client.failures == []
+    assertSynced(downloadDir, canvas)
+    for f in canvas.files[1]:
+        requests = requestsOf(canvas, f)
+        failed = [r for _, _, r, status in requests if status == 503]
+        assert len(failed) == 1
+        # the failed range alone is downloaded again
+        assert sorted(r for _, _, r, status in requests if status == 206) == sorted(
+            ["bytes=0-24999", "bytes=25000-49999", "bytes=50000-74999"]
+            + ["bytes=75000-99999"]
+        )
+        assert [r for _, _, r, _ in requests].count(failed[0]) == 2
+
+
+def testSplitResume(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 1}, fileSize=lambda i: 100000)
+    f = canvas.listedFile(1, 0)
+    # a run killed with the first part done and the third one half done
+    content = bytearray(f["size"])
+    content[:25000] = canvas.content(f["id"], 0, 25000)
+    content[50000:60000] = canvas.content(f["id"], 50000, 60000)
+    path = localPath(downloadDir, canvas, f)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".temp", "wb") as temp:
+        temp.write(content)
+    parts = [[25000, 24999], [25000, 49999], [60000, 74999], [75000, 99999]]
+    with open(path + ".temp.parts", "w") as state:
+        validator = f'"{f["id"]}-{f["modified_at"]}"'
+        json.dump({"size": f["size"], "validator": validator, "parts": parts}, state)
+    syncer = runSync(splitConfig(canvas, downloadDir))
+    assert syncer.client.failures == []
+    assertSynced(downloadDir, canvas)
+    assert sorted(r for _, _, r, _ in requestsOf(canvas, f)) == [
+        "bytes=25000-49999",
+        "bytes=60000-74999",
+        "bytes=75000-99999",
+    ]
+    assert not os.path.exists(path + ".temp.parts")
+
+
+def testSplitResumeChangedFile(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 1}, fileSize=lambda i: 100000)
+    f = canvas.listedFile(1, 0)
+    path = localPath(downloadDir, canvas, f)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".temp", "wb") as temp:
+        temp.write(bytes(f["size"]))
+    parts = [[25000, 24999], [25000, 49999], [50000, 74999], [75000, 99999]]
+    with open(path + ".temp.parts", "w") as state:
+        json.dump({"size": f["size"], "validator": '"old"', "parts": parts}, state)
+    syncer = runSync(splitConfig(canvas, downloadDir))
+    assert syncer.client.failures == []
+    # the stale first part is not kept
+    assertSynced(downloadDir, canvas)
@@ -0,0 +1,52 @@
+import os
+import threading
+from types import SimpleNamespace
+
+import canvassyncer.__main__ as main
+from tests.mockcanvas import assertSynced, makeConfig, runSync
+
+
+def recordThreads(monkeypatch, owner, name, threads):
+    func = getattr(owner, name)
+
+    def wrapper(*args, **kwargs):
+        threads.append((name, threading.current_thread().name))
+        return func(*args, **kwargs)
+
+    monkeypatch.setattr(owner, name, wrapper)
+
+
+def testIndexCacheAndLinksOffEventLoop(canvas, downloadDir, tmp_path, monkeypatch):
+    canvas.duplicate(canvas.listedFile(2, 1)["id"], canvas.listedFile(1, 1)["id"])
+    threads = []
+    recordThreads(monkeypatch, main.SyncIndex, "append", threads)
+    recordThreads(monkeypatch, main.ResponseCache, "get", threads)
+    recordThreads(monkeypatch, main.ResponseCache, "put", threads)
+    recordThreads(monkeypatch, main, "linkFile", threads)
+    config = makeConfig(
+        canvas, downloadDir, "--dedup", "--cache-dir", str(tmp_path / "cache")
+    )
+    syncer = runSync(config)
+    assertSynced(downloadDir, canvas)
+    assert syncer.linkedCount == 1
+    assert {name for name, _ in threads} == {"append", "get", "put", "linkFile"}
+    assert all(thread.startswith("canvassyncer-fs") for _, thread in threads)
+
+
+def testCacheEvictsLeastRecentlyUsed(tmp_path):
+    cache = main.ResponseCache(str(tmp_path), 300, "token")
+    resp = SimpleNamespace(headers={"etag": '"1"'})
+    for url in ("a", "b"):
+        cache.put(url, resp, ["x" * 50], {})
+    cache.touch("a")
+    cache.put("c", resp, ["x" * 50], {})
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert len(os.listdir(tmp_path)) == 2
+    # a restart orders the entries by their modification time
+    os.utime(cache.entryPath("c"), (0, 0))
+    cache = main.ResponseCache(str(tmp_path), 300, "token")
+    cache.put("d", resp, ["x" * 50], {})
+    assert cache.get("a") is not None
+    assert cache.get("c") is None
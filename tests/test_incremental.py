@@ -0,0 +1,27 @@
+from tests.mockcanvas import assertSynced, makeConfig, runSync
+
+
+def testIncrementalListing(mockCanvas, downloadDir):
+    # every file shares one updated_at, like after a course copy
+    canvas = mockCanvas(courses={1: 250})
+
+    def filesRequests(*argv):
+        requests = canvas.requests["courses/N/files"]
+        syncer = runSync(makeConfig(canvas, downloadDir, "--incremental", *argv))
+        assert syncer.client.failures == []
+        return canvas.requests["courses/N/files"] - requests
+
+    assert filesRequests() == 3
+    assert canvas.downloads() == 250
+    # nothing changed, the first page holds nothing new
+    assert filesRequests() == 1
+    assert canvas.downloads() == 250
+    # the changed file comes first, the page after it holds nothing new
+    canvas.touch(canvas.listedFile(1, 200)["id"])
+    assert filesRequests() == 2
+    assert canvas.downloads() == 251
+    assertSynced(downloadDir, canvas)
+    assert filesRequests() == 1
+    # the full listing is fanned out again once it is due
+    assert filesRequests("--full-listing-interval", "0") == 3
+    assert canvas.downloads() == 251
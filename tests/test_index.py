@@ -0,0 +1,36 @@
+import os
+
+from tests.mockcanvas import assertSynced, localPath, makeConfig, runSync
+
+
+def testVerifyReplacesCorruptFile(canvas, downloadDir, capsys):
+    runSync(makeConfig(canvas, downloadDir))
+    f = canvas.listedFile(1, 3)
+    path = localPath(downloadDir, canvas, f)
+    with open(path, "r+b") as local:
+        local.write(b"corrupt")
+    syncer = runSync(makeConfig(canvas, downloadDir, "--verify"))
+    assert syncer.client.failures == []
+    assertSynced(downloadDir, canvas)
+    assert canvas.downloads() == 18
+    # no older version of a corrupt file is kept
+    assert os.listdir(os.path.dirname(path)).count("f3.pdf") == 1
+    assert not [name for name in os.listdir(os.path.dirname(path)) if "_f3" in name]
+    out = capsys.readouterr().out
+    assert "f3.pdf (0.0MB, corrupt)" in out
+    assert "later version" not in out
+    # the new copy is intact
+    runSync(makeConfig(canvas, downloadDir, "--verify"))
+    assert canvas.downloads() == 18
+
+
+def testLocalEditsAreKept(canvas, downloadDir, capsys):
+    runSync(makeConfig(canvas, downloadDir))
+    path = localPath(downloadDir, canvas, canvas.listedFile(1, 3))
+    with open(path, "ab") as local:
+        local.write(b"annotation")
+    runSync(makeConfig(canvas, downloadDir, "--no-keep-older-version"))
+    assert canvas.downloads() == 17
+    assert "later version" not in capsys.readouterr().out
+    with open(path, "rb") as local:
+        assert local.read().endswith(b"annotation")
@@ -0,0 +1,37 @@
+import asyncio
+import json
+
+from canvassyncer.__main__ import sync
+from tests.mockcanvas import assertSynced, makeConfig
+
+
+def testReportAndMetrics(mockCanvas, downloadDir, tmp_path):
+    # every download fails once with a 503
+    canvas = mockCanvas(courses={1: 6, 2: 4}, failFirst=1, failKinds={"download"})
+    reportPath, metricsPath = tmp_path / "report.json", tmp_path / "metrics.prom"
+    config = makeConfig(
+        canvas, downloadDir, "--report", str(reportPath), "--metrics", str(metricsPath)
+    )
+    asyncio.run(sync([config]))
+    assertSynced(downloadDir, canvas)
+    sizes = {
+        courseID: sum(f["size"] for f in files)
+        for courseID, files in canvas.files.items()
+    }
+    with open(reportPath) as f:
+        report = json.load(f)
+    assert report["downloadedBytes"] == sum(sizes.values())
+    assert report["courses"]["TEST1"]["files"] == 6
+    assert report["courses"]["TEST2"]["files"] == 4
+    assert report["retries"] == {"download": 10}
+    assert report["requests"]["download"]["count"] == 20
+    assert {"getCourseID", "getCourseTaskInfo", "downloadMany"} <= set(report["phases"])
+    with open(metricsPath) as f:
+        lines = f.read().splitlines()
+    assert 'canvassyncer_retries_total{kind="download"} 10' in lines
+    assert 'canvassyncer_request_duration_seconds_count{kind="download"} 20' in lines
+    for courseID, size in sizes.items():
+        assert (
+            f'canvassyncer_downloaded_bytes_total{{course="TEST{courseID}"}} {size}'
+            in lines
+        )
@@ -0,0 +1,22 @@
+from urllib.parse import urlsplit
+
+from tests.mockcanvas import assertSynced, makeConfig, runSync
+
+
+def testPipeline(mockCanvas, downloadDir):
+    # the pages of the large course are listed one after another
+    canvas = mockCanvas(courses={1: 5, 2: 500}, latency=0.02, exposeLast=False)
+    syncer = runSync(makeConfig(canvas, downloadDir, "--pipeline"))
+    assert syncer.client.failures == []
+    assertSynced(downloadDir, canvas)
+    assert canvas.downloads() == 505
+    paths = [urlsplit(path).path for _, path, *_ in canvas.log]
+    firstDownload = next(i for i, p in enumerate(paths) if p.endswith("/download"))
+    lastListing = max(i for i, p in enumerate(paths) if p == "/api/v1/courses/2/files")
+    # downloads start while the listing of the large course is still running
+    assert firstDownload < lastListing
+    # files updated on canvas are downloaded once the listing is done
+    canvas.touch(canvas.listedFile(1, 1)["id"])
+    runSync(makeConfig(canvas, downloadDir, "--pipeline"))
+    assert canvas.downloads() == 506
+    assertSynced(downloadDir, canvas)
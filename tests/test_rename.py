@@ -0,0 +1,61 @@
+import json
+import os
+
+from canvassyncer.__main__ import INDEX_FILENAME
+from tests.mockcanvas import assertSynced, localPath, makeConfig, runSync
+
+
+def indexLines(downloadDir):
+    with open(os.path.join(downloadDir, INDEX_FILENAME)) as f:
+        return [json.loads(line) for line in f]
+
+
+def relative(downloadDir, path):
+    return os.path.relpath(path, downloadDir).replace("\\", "/")
+
+
+def renameAndMove(canvas, downloadDir):
+    # f1.pdf is renamed in its folder, f2.pdf moves to folder1
+    renamed, moved = canvas.listedFile(1, 1), canvas.listedFile(1, 2)
+    oldPaths = [localPath(downloadDir, canvas, f) for f in (renamed, moved)]
+    canvas.rename(renamed["id"], "renamed.pdf")
+    canvas.rename(moved["id"], moved["display_name"], folderID=1001)
+    newPaths = [localPath(downloadDir, canvas, f) for f in (renamed, moved)]
+    assert newPaths[1].endswith("TEST1/folder1/f2.pdf")
+    return oldPaths, newPaths
+
+
+def testRenamedFilesAreMoved(canvas, downloadDir):
+    runSync(makeConfig(canvas, downloadDir))
+    oldPaths, newPaths = renameAndMove(canvas, downloadDir)
+    syncer = runSync(makeConfig(canvas, downloadDir))
+    assert syncer.movedCount == 2
+    assert canvas.downloads() == 17
+    assertSynced(downloadDir, canvas)
+    lines = indexLines(downloadDir)
+    for oldPath, newPath in zip(oldPaths, newPaths):
+        assert not os.path.exists(oldPath)
+        assert {"path": relative(downloadDir, oldPath), "deleted": True} in lines
+
+
+def testPlanAndApplyMoves(canvas, downloadDir):
+    runSync(makeConfig(canvas, downloadDir))
+    oldPaths, newPaths = renameAndMove(canvas, downloadDir)
+    planPath = str(downloadDir) + ".plan"
+    runSync(makeConfig(canvas, downloadDir, "--plan", planPath))
+    with open(planPath) as f:
+        entries = [json.loads(line) for line in f]
+    moves = sorted(
+        (entry["from"], entry["path"]) for entry in entries if entry["action"] == "move"
+    )
+    assert moves == sorted(
+        (relative(downloadDir, old), relative(downloadDir, new))
+        for old, new in zip(oldPaths, newPaths)
+    )
+    # a plan moves nothing
+    assert all(os.path.exists(path) for path in oldPaths)
+    syncer = runSync(makeConfig(canvas, downloadDir, "--apply", planPath))
+    assert syncer.movedCount == 2
+    assert canvas.downloads() == 17
+    assertSynced(downloadDir, canvas)
+    assert not any(os.path.exists(path) for path in oldPaths)
@@ -0,0 +1,42 @@
+import time
+from urllib.parse import urlsplit
+
+from tests.mockcanvas import assertSynced, makeConfig, runSync
+
+
+def downloadOrder(canvas):
+    # one connection downloads the files one after another
+    return [
+        canvas.file(int(urlsplit(path).path.split("/")[2]))
+        for _, path, *_ in canvas.log
+        if urlsplit(path).path.endswith("/download")
+    ]
+
+
+def testOrderSmallest(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 10}, fileSize=lambda i: 1000 + (i * 7919) % 10000)
+    runSync(makeConfig(canvas, downloadDir, "-c", "1", "--order", "smallest"))
+    assertSynced(downloadDir, canvas)
+    sizes = [f["size"] for f in downloadOrder(canvas)]
+    assert len(sizes) == 10
+    assert sizes == sorted(sizes)
+
+
+def testTypePriority(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 10})
+    config = makeConfig(canvas, downloadDir, "-c", "1", "--type-priority", "other=1")
+    runSync(config)
+    assertSynced(downloadDir, canvas)
+    names = [f["display_name"] for f in downloadOrder(canvas)]
+    # the videos come before the files of a lower priority
+    assert names == sorted(names, key=lambda name: not name.endswith(".mp4"))
+    assert names[0].endswith(".mp4") and names[-1].endswith(".pdf")
+
+
+def testMaxRate(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 5}, fileSize=lambda i: 40000)
+    start = time.monotonic()
+    runSync(makeConfig(canvas, downloadDir, "--max-rate", "0.1"))
+    # 200 kB at 100 kB/s, after a burst of a second's worth
+    assert time.monotonic() - start >= 0.9
+    assertSynced(downloadDir, canvas)
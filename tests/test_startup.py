@@ -0,0 +1,24 @@
+import subprocess
+import sys
+
+from canvassyncer.__main__ import __version__, fileCategory
+
+
+def testVersionSkipsHeavyImports():
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "canvassyncer", "-V"],
+        capture_output=True,
+        text=True,
+    )
+    assert res.stdout.strip() == __version__
+    modules = {line.rsplit("|", 1)[-1].strip() for line in res.stderr.splitlines()}
+    assert "httpx" not in modules
+    assert "tqdm" not in modules
+
+
+def testFileCategories():
+    assert fileCategory("lecture.MP4") == "video"
+    assert fileCategory("a.b/notes.mp3") == "audio"
+    assert fileCategory("figure.jpeg") == "image"
+    assert fileCategory("slides.pdf") == "other"
+    assert fileCategory("README") == "other"
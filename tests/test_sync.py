@@ -0,0 +1,107 @@
+import asyncio
+import os
+
+from canvassyncer.__main__ import CanvasSyncer, SharedPool, poolOptions, sync, syncOne
+from tests.mockcanvas import assertSynced, localPath, makeConfig, runSync
+
+
+def testColdSync(canvas, downloadDir):
+    syncer = runSync(makeConfig(canvas, downloadDir))
+    assert syncer.client.failures == []
+    assertSynced(downloadDir, canvas)
+    assert canvas.downloads() == 17
+
+
+def testNoopSync(canvas, downloadDir):
+    config = makeConfig(canvas, downloadDir)
+    runSync(config)
+    runSync(config)
+    assert canvas.downloads() == 17
+
+
+def testUpdatedFile(canvas, downloadDir):
+    config = makeConfig(canvas, downloadDir)
+    runSync(config)
+    f = canvas.listedFile(1, 3)
+    canvas.touch(f["id"])
+    syncer = runSync(config)
+    assert syncer.client.failures == []
+    assert canvas.downloads() == 18
+    assertSynced(downloadDir, canvas)
+    # the older version is kept by default
+    folder = os.path.dirname(localPath(downloadDir, canvas, f))
+    assert len([name for name in os.listdir(folder) if "f3.pdf" in name]) == 2
+
+
+def testPagination(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 250})
+    runSync(makeConfig(canvas, downloadDir, "--plan", str(downloadDir) + ".plan"))
+    # per_page=100, the pages after the first are fanned out from rel="last"
+    assert canvas.requests["courses/N/files"] == 3
+    assert canvas.requests["courses/N/folders"] == 1
+
+
+def testPaginationWithoutLast(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 250}, exposeLast=False)
+    syncer = runSync(makeConfig(canvas, downloadDir))
+    assert canvas.requests["courses/N/files"] == 3
+    assert syncer.totalFileCount == 250
+
+
+def testRetries(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 8}, failFirst=1)
+    syncer = runSync(makeConfig(canvas, downloadDir))
+    assert syncer.client.failures == []
+    assertSynced(downloadDir, canvas)
+    assert canvas.statuses[503] > 0
+
+
+def testSplitDownload(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 6}, fileSize=lambda i: 100000 + i)
+    config = makeConfig(canvas, downloadDir, "--split-size", "0", "--split-count", "4")
+    syncer = runSync(config)
+    assert syncer.client.failures == []
+    assertSynced(downloadDir, canvas)
+    ranges = [entry for entry in canvas.log if entry[2]]
+    assert len(ranges) == canvas.downloads() == 24
+    assert all(status == 206 for *_, status in ranges)
+
+
+def testWorkers(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 6, 2: 6, 3: 6})
+    config = makeConfig(canvas, downloadDir, "--workers", "2")
+    asyncio.run(sync([config]))
+    assertSynced(downloadDir, canvas)
+    assert canvas.downloads() == 18
+
+
+def testPlanLeavesDownloadDirUntouched(canvas, downloadDir):
+    planPath = str(downloadDir) + ".plan"
+    runSync(makeConfig(canvas, downloadDir, "--plan", planPath))
+    assert os.path.exists(planPath)
+    # only the course cache is written, no course folder is created
+    assert os.listdir(downloadDir) == [".canvassyncer_courses.json"]
+
+
+def testSharedPoolForgetsFinishedDownloads(canvas, downloadDir):
+    config = makeConfig(canvas, downloadDir)
+
+    async def syncTwice():
+        pool = SharedPool(
+            config["connection_count"], config["proxy"], **poolOptions(config)
+        )
+        try:
+            for touched in (None, canvas.listedFile(1, 1)):
+                if touched:
+                    # the same URL and size, but new content
+                    canvas.touch(touched["id"])
+                syncer = CanvasSyncer(config, pool)
+                await syncOne(syncer)
+                await syncer.aclose()
+                assert pool.downloads == {}
+        finally:
+            await pool.aclose()
+
+    asyncio.run(syncTwice())
+    assertSynced(downloadDir, canvas)
+    assert canvas.downloads() == 18
@@ -0,0 +1,20 @@
+from tests.mockcanvas import assertSynced, makeConfig, runSync
+
+
+def testThrottledDownloadsDoNotFail(mockCanvas, downloadDir, capsys):
+    canvas = mockCanvas(
+        courses={1: 60}, latency=0.05, maxConcurrent=3, retryAfter="0.2"
+    )
+    syncer = runSync(makeConfig(canvas, downloadDir, "-c", "16"))
+    assert canvas.statuses[429] > 0
+    assert syncer.client.failures == []
+    assertSynced(downloadDir, canvas)
+    # retries are only reported with --debug
+    assert "Retry." not in capsys.readouterr().out
+
+
+def testServerErrorsUseUpRetries(mockCanvas, downloadDir):
+    canvas = mockCanvas(courses={1: 3}, failFirst=5, failKinds={"download"})
+    syncer = runSync(makeConfig(canvas, downloadDir))
+    assert len(syncer.client.failures) == 3
+    assert canvas.downloads() == 9
@@ -0,0 +1,38 @@
+import asyncio
+
+from canvassyncer.__main__ import CanvasSyncer
+from tests.mockcanvas import assertSynced, makeConfig
+
+
+def testWatchSkipsUnchangedCourses(canvas, downloadDir):
+    config = makeConfig(canvas, downloadDir, "--watch", "0.01")
+    requests = []
+
+    async def watch():
+        syncer = CanvasSyncer(config)
+        sync = syncer.sync
+        done = asyncio.Event()
+
+        async def recordedSync():
+            await sync()
+            requests.append(dict(canvas.courseRequests))
+            if len(requests) == 2:
+                canvas.touch(canvas.listedFile(2, 1)["id"])
+            if len(requests) == 3:
+                done.set()
+
+        syncer.sync = recordedSync
+        task = asyncio.create_task(syncer.watch(config["watch"]))
+        await done.wait()
+        task.cancel()
+        await syncer.aclose()
+
+    asyncio.run(watch())
+    assertSynced(downloadDir, canvas)
+    assert canvas.downloads() == 18
+    first, second, third = requests
+    # each sync asks every course for its latest change first
+    assert second[1] - first[1] == 1
+    assert second[2] - first[2] == 1
+    assert third[1] - second[1] == 1
+    assert third[2] - second[2] > 1